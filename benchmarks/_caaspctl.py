@@ -0,0 +1,21 @@
+#
+# Run caaspctl, saving its peak memory usage (in KB) and the
+# number of modules imported in $CAASP_BENCH_RUSAGE
+#
+
+import atexit
+import os
+import resource
+import runpy
+import sys
+
+
+def _save_rusage():
+    with open(os.environ['CAASP_BENCH_RUSAGE'], 'w') as f:
+        f.write('{} {}\n'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                 len(sys.modules)))
+
+
+atexit.register(_save_rusage)
+sys.argv[0] = 'caaspctl'
+runpy.run_module('caasp', run_name='__main__', alter_sys=True)
@@ -0,0 +1,99 @@
+#
+# Helpers for the stand-ins of the tools in a CaaSP Admin Node.
+#
+# Everything is kept in $CAASP_BENCH_DIR:
+#
+#   spawns          one line per process started (for counting them)
+#   keys/{pre,acc}  the minion keys (one empty file per minion)
+#   late-keys       minions that "appear" while watching the events bus
+#   grains.json     the grains of the minions
+#   db.sqlite       the database
+#   root/           files "inside" the containers
+#
+
+import json
+import os
+import re
+import sys
+import time
+
+BENCH_DIR = os.environ['CAASP_BENCH_DIR']
+LATENCY = float(os.environ.get('CAASP_BENCH_LATENCY', '0'))
+
+
+def path(*comps):
+    return os.path.join(BENCH_DIR, *comps)
+
+
+def start(name):
+    ''' Record the process and simulate the startup time of the real tool '''
+    with open(path('spawns'), 'a') as f:
+        f.write(name + '\n')
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+def keys(status):
+    return sorted(os.listdir(path('keys', status)))
+
+
+def accept(minion):
+    os.rename(path('keys', 'pre', minion), path('keys', 'acc', minion))
+
+
+def load_grains():
+    try:
+        with open(path('grains.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def load_pillar():
+    ''' The pillar of all the minions (the same for everyone) '''
+    try:
+        with open(path('pillar.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_grains(grains):
+    tmp = path('grains.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(grains, f)
+    os.rename(tmp, path('grains.json'))
+
+
+def _match_grain(grains, expr, regex):
+    key, _, value = expr.partition(':')
+    values = grains.get(key)
+    if not isinstance(values, list):
+        values = [values]
+    for v in values:
+        if v is None:
+            continue
+        if (regex and re.match(value, str(v))) or (not regex and str(v) == value):
+            return True
+    return False
+
+
+def match(tgt):
+    ''' The (accepted) minions matched by a (simple) compound target '''
+    minions = keys('acc')
+    if tgt in ['*', '']:
+        return minions
+    if tgt.startswith('L@'):
+        wanted = set(tgt[2:].split(','))
+        return [m for m in minions if m in wanted]
+
+    all_grains = load_grains()
+    if tgt.startswith('G@') or tgt.startswith('P@'):
+        return [m for m in minions
+                if _match_grain(all_grains.get(m, {}), tgt[2:], tgt.startswith('P@'))]
+    return [m for m in minions if m == tgt]
+
+
+def fail(msg, code=1):
+    sys.stderr.write(msg + '\n')
+    sys.exit(code)
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+'''
+Benchmarks for caaspctl, with a simulated CaaSP Admin Node.
+
+`docker`, `salt`, `salt-key`, `salt-run` and `mysql` are replaced by the
+stand-ins in `fakes/`, with a configurable number of minions and latency,
+so the benchmarks can run in any Linux box. For each workload and cluster
+size this measures the (wall) time, the processes spawned and the peak
+memory of caaspctl.
+
+Usage:
+
+    $ python benchmarks/run.py --minions 10,100,1000 --json results.json
+    $ python benchmarks/run.py --minions 10,100,1000 --compare results.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, OrderedDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKES_DIR = os.path.join(BENCH_DIR, 'fakes')
+TOP_DIR = os.path.dirname(BENCH_DIR)
+
+DB_PASSWORD_FILE = '/var/lib/misc/infra-secrets/mariadb-root-password'
+MINION_NAME = 'bench-{:05d}'
+MASTER_ROLE = 'kube-master'
+MINION_ROLE = 'kube-minion'
+
+# number of keys in the pillar of the `config-get` workload
+PILLAR_SIZE = 2000
+
+# a change in the time (or spawns, or memory) is reported
+# in a comparison when it is bigger than this
+COMPARE_THRESHOLD = 0.10
+
+# target for the time of starting caaspctl (`caaspctl version`), in seconds
+STARTUP_TARGET = 0.15
+STARTUP_MIN_REPEAT = 10
+
+
+def minion_names(num):
+    return [MINION_NAME.format(n) for n in range(num)]
+
+
+class Cluster(object):
+    '''
+    A simulated cluster: the state of the fakes, in a temporary directory
+    '''
+
+    def __init__(self, num_minions, opts):
+        self.num_minions = num_minions
+        self.opts = opts
+        self.workdir = tempfile.mkdtemp(prefix='caasp-bench-')
+        for d in ['keys/pre', 'keys/acc', 'root' + os.path.dirname(DB_PASSWORD_FILE), 'state']:
+            os.makedirs(self.path(d))
+        with open(self.path('root' + DB_PASSWORD_FILE), 'w') as f:
+            f.write('bench\n')
+        open(self.path('spawns'), 'w').close()
+
+    def path(self, *comps):
+        return os.path.join(self.workdir, *comps)
+
+    def add_keys(self, minions, status):
+        for m in minions:
+            open(self.path('keys', status, m), 'w').close()
+
+    def add_late_keys(self, minions):
+        ''' Minions that will submit their keys while we are waiting for them '''
+        with open(self.path('late-keys'), 'w') as f:
+            f.write('\n'.join(minions) + '\n')
+
+    def set_roles(self, roles):
+        ''' Set the `roles` grain in the minions, from a `{minion: [roles]}` '''
+        with open(self.path('grains.json'), 'w') as f:
+            json.dump({m: {'id': m, 'roles': r} for m, r in roles.items()}, f)
+
+    def write(self, name, lines):
+        with open(self.path(name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return self.path(name)
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'PATH': FAKES_DIR + os.pathsep + env.get('PATH', ''),
+            'PYTHONPATH': TOP_DIR,
+            'DOCKER_HOST': 'tcp://127.0.0.1:2375',
+            'CAASPCTL_STATE_DIR': self.path('state'),
+            'CAASP_BENCH_DIR': self.workdir,
+            'CAASP_BENCH_RUSAGE': self.path('rusage'),
+            'CAASP_BENCH_LATENCY': str(self.opts.latency),
+            'CAASP_BENCH_SALT_LATENCY': str(self.opts.salt_latency),
+            'CAASP_BENCH_DOCKER_LATENCY': str(self.opts.docker_latency),
+            'CAASP_BENCH_ARRIVAL': str(self.opts.arrival),
+        })
+        # (otherwise the sources could be compiled in every run)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        return env
+
+    def spawns(self):
+        with open(self.path('spawns')) as f:
+            return Counter(line.strip() for line in f if line.strip())
+
+    def usage(self):
+        ''' The peak memory used by caaspctl (in KB) and the number of modules imported '''
+        try:
+            with open(self.path('rusage')) as f:
+                rss, modules = f.read().split()
+                return int(rss), int(modules)
+        except (IOError, ValueError):
+            return None, None
+
+    def destroy(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+#########################
+# workloads
+#########################
+
+def workload_config_load(cluster):
+    ''' `config load` of as many keys as minions '''
+    cluster.add_keys(minion_names(cluster.num_minions), 'acc')
+    filename = cluster.write('config.lst', ['bench:key{:05d}  value{}'.format(n, n)
+                                            for n in range(cluster.num_minions)])
+    return ['config load ' + filename]
+
+
+def workload_nodes_accept(cluster):
+    ''' `nodes accept N`, with half of the minions joining while we wait '''
+    minions = minion_names(cluster.num_minions)
+    half = len(minions) // 2
+    cluster.add_keys(minions[:half], 'pre')
+    cluster.add_late_keys(minions[half:])
+    return ['nodes accept {}'.format(cluster.num_minions)]
+
+
+def workload_roles_get(cluster):
+    ''' `roles get` in all the nodes '''
+    minions = minion_names(cluster.num_minions)
+    cluster.add_keys(minions, 'acc')
+    cluster.set_roles({m: [MASTER_ROLE if n == 0 else MINION_ROLE]
+                       for n, m in enumerate(minions)})
+    return ['roles get']
+
+
+def workload_script(cluster):
+    ''' A full provisioning, as a `--script` '''
+    minions = minion_names(cluster.num_minions)
+    half = len(minions) // 2
+    cluster.add_keys(minions[:half], 'pre')
+    cluster.add_late_keys(minions[half:])
+    config = cluster.write('config.lst', ['bench:key{:05d}  value{}'.format(n, n)
+                                          for n in range(cluster.num_minions)])
+    return ['config load ' + config,
+            'config set api:server:external_fqdn bench.example.com',
+            'nodes accept {}'.format(cluster.num_minions),
+            'roles set {} {}'.format(minions[0], MASTER_ROLE),
+            'roles set * {}'.format(MINION_ROLE),
+            'roles get',
+            'nodes masters',
+            'apply bootstrap']
+
+
+def workload_config_get(cluster):
+    ''' `config get` of all the pillar (a big one) in all the nodes '''
+    minions = minion_names(cluster.num_minions)
+    cluster.add_keys(minions, 'acc')
+    cluster.set_roles({m: ['ca'] for m in minions})
+    with open(cluster.path('pillar.json'), 'w') as f:
+        json.dump({'bench': {'key{:05d}'.format(n): 'value{}'.format(n) for n in range(PILLAR_SIZE)}}, f)
+    return ['config get']
+
+
+def workload_startup(cluster):
+    ''' Just start caaspctl (the cluster size does not matter) '''
+    return ['version']
+
+
+WORKLOADS = OrderedDict([
+    ('startup', workload_startup),
+    ('config-load', workload_config_load),
+    ('nodes-accept', workload_nodes_accept),
+    ('roles-get', workload_roles_get),
+    ('config-get', workload_config_get),
+    ('script', workload_script),
+])
+
+
+#########################
+# running
+#########################
+
+def run_once(workload, num_minions, opts):
+    cluster = Cluster(num_minions, opts)
+    try:
+        commands = WORKLOADS[workload](cluster)
+        script = cluster.write('script.txt', commands)
+        cmd = [sys.executable, os.path.join(BENCH_DIR, '_caaspctl.py'),
+               '--skip-rc-files', '--docker-cli', '--exit-on-error',
+               '--script', script, '--script-only'] + opts.caaspctl_args
+        with open(cluster.path('output'), 'w') as out:
+            start = time.perf_counter()
+            proc = subprocess.run(cmd, env=cluster.env(), cwd=cluster.workdir,
+                                  stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT,
+                                  timeout=opts.timeout)
+            elapsed = time.perf_counter() - start
+
+        if proc.returncode != 0:
+            with open(cluster.path('output')) as f:
+                output = f.read()
+            raise RuntimeError('{} with {} minions failed ({}):\n{}'.format(
+                workload, num_minions, proc.returncode, output[-4000:]))
+
+        spawns = cluster.spawns()
+        rss, modules = cluster.usage()
+        return OrderedDict([('time', elapsed),
+                            ('spawns', sum(spawns.values())),
+                            ('spawns_by_tool', OrderedDict(sorted(spawns.items()))),
+                            ('peak_rss_kb', rss),
+                            ('modules', modules)])
+    finally:
+        if opts.keep:
+            print('kept {}'.format(cluster.workdir), file=sys.stderr)
+        else:
+            cluster.destroy()
+
+
+def run_benchmark(workload, num_minions, opts):
+    repeat = opts.repeat
+    if workload == 'startup':
+        repeat = max(repeat, STARTUP_MIN_REPEAT)  # (it is quick, but noisy)
+
+    # a first run for warming up the caches (and compiling the bytecode)
+    run_once(workload, num_minions, opts)
+    runs = [run_once(workload, num_minions, opts) for _ in range(repeat)]
+    times = [r['time'] for r in runs]
+    return OrderedDict([('workload', workload),
+                        ('minions', num_minions),
+                        ('time_median', statistics.median(times)),
+                        ('time_min', min(times)),
+                        ('time_max', max(times)),
+                        ('spawns', runs[-1]['spawns']),
+                        ('spawns_by_tool', runs[-1]['spawns_by_tool']),
+                        ('peak_rss_kb', max(r['peak_rss_kb'] or 0 for r in runs)),
+                        ('modules', runs[-1]['modules'])])
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                      cwd=TOP_DIR, stderr=subprocess.DEVNULL)
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#########################
+# reporting
+#########################
+
+def format_results(results):
+    header = '{:<14} {:>8} {:>10} {:>10} {:>8} {:>10} {:>8}  {}'.format(
+        'workload', 'minions', 'median(s)', 'min(s)', 'spawns', 'rss(KB)', 'modules', 'spawns by tool')
+    lines = [header, '-' * len(header)]
+    for r in results:
+        by_tool = ' '.join('{}={}'.format(k, v) for k, v in r['spawns_by_tool'].items())
+        lines.append('{:<14} {:>8} {:>10.3f} {:>10.3f} {:>8} {:>10} {:>8}  {}'.format(
+            r['workload'], r['minions'], r['time_median'], r['time_min'],
+            r['spawns'], r['peak_rss_kb'], r['modules'], by_tool))
+    return lines
+
+
+def format_comparison(old, results):
+    ''' Compare some results with some previous ones (from `--json`) '''
+    previous = {(r['workload'], r['minions']): r for r in old['results']}
+    lines = ['comparing with {} (python {})'.format(old.get('commit'), old.get('python')),
+             '{:<14} {:>8} {:>18} {:>14} {:>18}'.format(
+                 'workload', 'minions', 'time(s)', 'spawns', 'rss(KB)')]
+
+    def delta(a, b, fmt):
+        if not a:
+            return fmt.format(b)
+        change = (b - a) / float(a)
+        mark = ' '
+        if abs(change) > COMPARE_THRESHOLD:
+            mark = '+' if change > 0 else '-'
+        return '{} {:+.0%}{}'.format(fmt.format(b), change, mark)
+
+    for r in results:
+        p = previous.get((r['workload'], r['minions']))
+        if not p:
+            continue
+        lines.append('{:<14} {:>8} {:>18} {:>14} {:>18}'.format(
+            r['workload'], r['minions'],
+            delta(p['time_median'], r['time_median'], '{:.3f}'),
+            delta(p['spawns'], r['spawns'], '{}'),
+            delta(p['peak_rss_kb'], r['peak_rss_kb'], '{}')))
+    return lines
+
+
+parser = argparse.ArgumentParser(description='Benchmarks for caaspctl, with a simulated CaaSP Admin Node')
+parser.add_argument('--minions', default='10,100,1000',
+                    help='comma-separated list of cluster sizes (default: %(default)s)')
+parser.add_argument('--workloads', default=','.join(WORKLOADS.keys()),
+                    help='comma-separated list of workloads (default: %(default)s)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='number of runs of each benchmark (default: %(default)s)')
+parser.add_argument('--latency', type=float, default=0.0,
+                    help='startup time of the fake tools, in seconds (default: %(default)s)')
+parser.add_argument('--salt-latency', type=float, default=0.0,
+                    help='time for publishing a Salt job and getting the returns (default: %(default)s)')
+parser.add_argument('--docker-latency', type=float, default=0.0,
+                    help='time for a `docker` command (default: %(default)s)')
+parser.add_argument('--arrival', type=float, default=0.0,
+                    help='interval between the minions joining in `nodes accept` (default: %(default)s)')
+parser.add_argument('--startup-target', type=float, default=STARTUP_TARGET,
+                    help='fail when starting caaspctl takes longer than this, in seconds (default: %(default)s)')
+parser.add_argument('--timeout', type=float, default=600,
+                    help='timeout for each run, in seconds (default: %(default)s)')
+parser.add_argument('--json', metavar='FILE',
+                    help='save the results in FILE')
+parser.add_argument('--compare', metavar='FILE',
+                    help='compare the results with some previous results saved with --json')
+parser.add_argument('--keep', action='store_true',
+                    help='keep the working directories (for debugging)')
+parser.add_argument('caaspctl_args', nargs='*',
+                    help='extra arguments for caaspctl (after a "--")')
+
+
+def main():
+    opts = parser.parse_args()
+    sizes = [int(n) for n in opts.minions.split(',')]
+    workloads = opts.workloads.split(',')
+    for w in workloads:
+        if w not in WORKLOADS:
+            parser.error('unknown workload "{}" (available: {})'.format(w, ', '.join(WORKLOADS)))
+
+    results = []
+    for workload in workloads:
+        for num in (sizes if workload != 'startup' else [0]):
+            print('running {} with {} minions...'.format(workload, num), file=sys.stderr)
+            results.append(run_benchmark(workload, num, opts))
+
+    print('\n'.join(format_results(results)))
+
+    slow_start = False
+    for r in results:
+        if r['workload'] == 'startup':
+            slow_start = r['time_median'] > opts.startup_target
+            print('\nstartup: {:.3f} secs (target: {:.3f} secs){}'.format(
+                r['time_median'], opts.startup_target, ': TOO SLOW' if slow_start else ''))
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            print('\n' + '\n'.join(format_comparison(json.load(f), results)))
+
+    if opts.json:
+        report = OrderedDict([('commit', git_commit()),
+                              ('python', platform.python_version()),
+                              ('platform', platform.platform()),
+                              ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                              ('options', OrderedDict([('repeat', opts.repeat),
+                                                       ('latency', opts.latency),
+                                                       ('salt_latency', opts.salt_latency),
+                                                       ('docker_latency', opts.docker_latency),
+                                                       ('arrival', opts.arrival),
+                                                       ('caaspctl_args', opts.caaspctl_args)])),
+                              ('results', results)])
+        with open(opts.json, 'w') as f:
+            json.dump(report, f, indent=4)
+        print('results saved in {}'.format(opts.json), file=sys.stderr)
+
+    if slow_start:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
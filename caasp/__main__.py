@@ -21,13 +21,13 @@
 #
 
 import argparse
+import atexit
+import importlib
+import threading
 
-from .apply import CaaSPApply
 from .cmdbase import CmdBase
 from .common import *
-from .config import CaaSPConfig
-from .nodes import CaaSPNodes
-from .roles import CaaSPRoles
+from .trace import tracer
 
 #
 # Command line arguments
@@ -50,14 +50,26 @@ verbose_group.add_argument('--debug',
                            action='store_true',
                            help='use debug logging')
 
+verbose_group.add_argument('--profile',
+                           dest='profile',
+                           default=False,
+                           action='store_true',
+                           help='print a summary of where the time was spent (and the slowest calls) when exiting')
+verbose_group.add_argument('--trace',
+                           dest='trace',
+                           metavar='FILE',
+                           default=None,
+                           help='write a trace of the commands, processes and Salt/DB calls to FILE (in the Chrome trace-event format)')
+
 script_group = parser.add_argument_group(
     title='Loading commands from scripts')
 
 script_group.add_argument('--script',
                           dest='script',
                           metavar='FILE',
-                          default='',
-                          help='read a list of commands from a script')
+                          action='append',
+                          default=[],
+                          help='read a list of commands from a script (can be repeated)')
 script_group.add_argument('--script-only',
                           dest='script_only',
                           default=True,
@@ -68,6 +80,11 @@ script_group.add_argument('--script-begin',
                           metavar='STAGE',
                           default='',
                           help='process the script after stage <STAGE>')
+script_group.add_argument('--no-script-cache',
+                          dest='no_script_cache',
+                          default=False,
+                          action='store_true',
+                          help='do not keep the scripts (and RC files) parsed between runs')
 
 commands_group = parser.add_argument_group(
     title='Commands processing',
@@ -88,13 +105,139 @@ commands_group.add_argument('--exit-on-error',
                             default=False,
                             action='store_true',
                             help='exit on any errors instead of just printing the error message')
+commands_group.add_argument('--max-parallel',
+                            dest='max_parallel',
+                            metavar='NUM',
+                            type=int,
+                            default=PARALLEL_MAX_WORKERS,
+                            help='max number of commands running at the same time in a parallel block')
 commands_group.add_argument('--skip-rc-files',
                             dest='skip_rc_files',
                             default=False,
                             action='store_true',
                             help='do not load automatically the RC files')
 
-readline.set_completer_delims(' \t\n')
+containers_group = parser.add_argument_group(
+    title='Containers')
+
+containers_group.add_argument('--docker-cli',
+                              dest='docker_cli',
+                              default=False,
+                              action='store_true',
+                              help='always use the "docker" command line client instead of the Docker Engine API socket')
+containers_group.add_argument('--db-cli',
+                              dest='db_cli',
+                              default=False,
+                              action='store_true',
+                              help='run a new "mysql" client for every SQL statement instead of keeping a database session')
+containers_group.add_argument('--docker-host',
+                              dest='docker_host',
+                              metavar='HOST',
+                              default=None,
+                              help='the Docker Engine of the Admin Node, like in $DOCKER_HOST (ie, "ssh://root@admin" or "tcp://admin:2376")')
+
+clusters_group = parser.add_argument_group(
+    title='Clusters',
+    description='Run the same commands (or scripts) in many clusters at the same time')
+
+clusters_group.add_argument('--cluster',
+                            dest='clusters',
+                            metavar='[NAME=]HOST',
+                            action='append',
+                            default=[],
+                            help='run in the cluster with the Admin Node at HOST (a Docker host, like in --docker-host) (can be repeated)')
+clusters_group.add_argument('--clusters-file',
+                            dest='clusters_file',
+                            metavar='FILE',
+                            default=None,
+                            help='run in the clusters in FILE (one [NAME=]HOST per line)')
+clusters_group.add_argument('--max-clusters',
+                            dest='max_clusters',
+                            metavar='NUM',
+                            type=int,
+                            default=FANOUT_MAX_CLUSTERS,
+                            help='max number of clusters where the commands are running at the same time')
+clusters_group.add_argument('--cluster-timeout',
+                            dest='cluster_timeout',
+                            metavar='SECS',
+                            type=int,
+                            default=None,
+                            help='stop the commands in a cluster when they take more than SECS seconds')
+
+salt_group = parser.add_argument_group(
+    title='Salt')
+
+salt_group.add_argument('--salt-transport',
+                        dest='salt_transport',
+                        default=SALT_TRANSPORT,
+                        choices=SALT_TRANSPORTS,
+                        help='how to talk to Salt: the CLI tools in the salt-master container or the salt-api')
+salt_group.add_argument('--salt-api-insecure',
+                        dest='salt_api_insecure',
+                        default=False,
+                        action='store_true',
+                        help='connect to the salt-api even when its certificate cannot be verified (the CA is not found)')
+salt_group.add_argument('--grain-cache-ttl',
+                        dest='grain_cache_ttl',
+                        metavar='SECS',
+                        type=int,
+                        default=GRAIN_CACHE_TTL,
+                        help='seconds the grains obtained from the minions are cached (0 for disabling the cache)')
+salt_group.add_argument('--roles-index-ttl',
+                        dest='roles_index_ttl',
+                        metavar='SECS',
+                        type=int,
+                        default=ROLES_INDEX_TTL,
+                        help='seconds the index of roles -> minions is kept (0 for targeting the roles with the grains matcher)')
+
+server_group = parser.add_argument_group(
+    title='Daemon',
+    description='Keep a caaspctl running (with its caches) and send it commands from other caaspctl')
+
+server_group.add_argument('--serve',
+                          dest='serve',
+                          default=False,
+                          action='store_true',
+                          help='run as a daemon, running the commands received in a unix socket')
+server_group.add_argument('--client',
+                          dest='client',
+                          default=False,
+                          action='store_true',
+                          help='run the commands (and scripts) in the daemon (see also "python -m caasp.client")')
+server_group.add_argument('--socket',
+                          dest='socket',
+                          metavar='PATH',
+                          default=None,
+                          help='the socket of the daemon (default: ${} or {} in the state directory)'.format(
+                              SERVER_SOCKET_ENV, SERVER_SOCKET_FILE))
+
+orch_group = parser.add_argument_group(
+    title='Orchestrations')
+
+orch_group.add_argument('--orch-report',
+                        dest='orch_report',
+                        metavar='FILE',
+                        default=None,
+                        help='write a (JSON) report with the timing of the states in the orchestrations')
+orch_group.add_argument('--force-sync',
+                        dest='force_sync',
+                        default=False,
+                        action='store_true',
+                        help='synchronize the Salt modules before the orchestrations even when they have not changed')
+
+# the options that are used in `--client` mode (any other option
+# must be used in the daemon)
+CLIENT_OPTIONS = ['client', 'socket', 'script', 'help']
+
+# the subcommands, as `name -> (module, class)`: they are
+# imported and created the first time they are used
+SUBCOMMANDS = {
+    'cache': ('.cache', 'CaaSPCache'),
+    'config': ('.config', 'CaaSPConfig'),
+    'apply': ('.apply', 'CaaSPApply'),
+    'nodes': ('.nodes', 'CaaSPNodes'),
+    'roles': ('.roles', 'CaaSPRoles'),
+}
 
 
 class CaaSP(CmdBase):
@@ -105,10 +248,22 @@ class CaaSP(CmdBase):
 
     def __init__(self, args):
         CmdBase.__init__(self, args)
-        self.config = CaaSPConfig(self, args)
-        self.apply = CaaSPApply(self, args)
-        self.nodes = CaaSPNodes(self, args)
-        self.roles = CaaSPRoles(self, args)
+        self._subcommands = {}
+        self._subcommands_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name not in SUBCOMMANDS:
+            raise AttributeError(name)
+
+        # (commands in parallel blocks could get here at the same time)
+        with self._subcommands_lock:
+            sub_cmd = self._subcommands.get(name)
+            if sub_cmd is None:
+                module, cls = SUBCOMMANDS[name]
+                module = importlib.import_module(module, __package__)
+                sub_cmd = getattr(module, cls)(self.args, top=self)
+                self._subcommands[name] = sub_cmd
+            return sub_cmd
 
     def _subcommand(self, sub_cmd, line):
         if len(line) > 0:
@@ -116,6 +271,10 @@ class CaaSP(CmdBase):
         else:
             sub_cmd.cmdloop()
 
+    def do_cache(self, line):
+        '''Grains cache.'''
+        self._subcommand(self.cache, line)
+
     def do_config(self, line):
         '''Configuration variables.'''
         self._subcommand(self.config, line)
@@ -140,30 +299,104 @@ class CaaSP(CmdBase):
         return True
 
 
+def _write_trace(args):
+    if args.trace:
+        tracer.write_chrome(args.trace)
+        log.info('trace written to %s', args.trace)
+    if args.profile:
+        sys.stderr.writelines(tracer.summary(PROFILE_TOP_N))
+
+
 def main():
     args = parser.parse_args()
 
+    # (when we are running in one of the clusters of a `--cluster`)
+    fanout_cluster = os.environ.get(FANOUT_CLUSTER_ENV)
+    if (args.clusters or args.clusters_file) and not fanout_cluster:
+        if args.client or args.serve or args.docker_host:
+            parser.error('--cluster/--clusters-file cannot be used with --client, --serve or --docker-host')
+
+    if args.client:
+        # the daemon runs the commands with its own options
+        ignored = [action.option_strings[0] for action in parser._actions
+                   if action.option_strings and action.dest not in CLIENT_OPTIONS and
+                   getattr(args, action.dest) != action.default]
+        if ignored:
+            parser.error('{} cannot be used with --client (use them in the --serve)'.format(
+                ', '.join(ignored)))
+
+        from .client import get_socket_path, run_client
+        try:
+            path = get_socket_path(args.socket)
+        except IOError as e:
+            parser.error(str(e))
+        sys.exit(run_client(path, args.args, args.script))
+
     loglevel = (logging.DEBUG if args.debug else logging.INFO)
     log = logging.getLogger(__name__)
     logging.basicConfig(stream=sys.stderr,
                         format=FORMAT,
                         level=loglevel)
 
-    try:
-        import coloredlogs
-
-        # By default the install() function installs a handler on the root logger,
-        # this means that log messages from your code and log messages from the
-        # libraries that you use will all show up on the terminal.
-        coloredlogs.install(fmt=FORMAT, level=loglevel)
-    except ImportError:
-        log.debug('"coloredlogs" not available')
+    # (colors are useless when the output is not a terminal, and
+    # importing "coloredlogs" is slow)
+    if sys.stderr.isatty():
+        try:
+            import coloredlogs
+
+            # By default the install() function installs a handler on the root logger,
+            # this means that log messages from your code and log messages from the
+            # libraries that you use will all show up on the terminal.
+            coloredlogs.install(fmt=FORMAT, level=loglevel)
+        except ImportError:
+            log.debug('"coloredlogs" not available')
+
+    # run a `caaspctl --docker-host` in every cluster (unless we are one of them)
+    if (args.clusters or args.clusters_file) and not fanout_cluster:
+        from .fanout import load_clusters, run_fanout
+        try:
+            clusters = load_clusters(args.clusters, args.clusters_file)
+        except (CommandError, IOError) as e:
+            log.critical('could not load the clusters: %s', e)
+            sys.exit(2)
+        sys.exit(run_fanout(clusters, sys.argv[1:], args.max_clusters, args.cluster_timeout))
+
+    if fanout_cluster:
+        # do not write the same files in all the clusters
+        from .fanout import cluster_filename
+        args.trace = cluster_filename(args.trace, fanout_cluster)
+        args.orch_report = cluster_filename(args.orch_report, fanout_cluster)
+
+    if args.profile or args.trace:
+        tracer.enable()
+        atexit.register(_write_trace, args)
+
+    if args.docker_host:
+        set_docker_host(args.docker_host)
+    if args.docker_cli:
+        set_docker_engine(False)
+    if args.db_cli:
+        set_db_pool(False)
+    set_salt_transport(args.salt_transport)
+    set_salt_api_insecure(args.salt_api_insecure)
+    set_grain_cache_ttl(args.grain_cache_ttl)
+    set_roles_index_ttl(args.roles_index_ttl)
 
     caasp_cmd = CaaSP(args)
 
     if not args.skip_rc_files:
         caasp_cmd.try_rc_files(CAASPCTL_RC_FILES)
 
+    if args.serve:
+        from .client import get_socket_path
+        from .server import serve
+        try:
+            serve(caasp_cmd, get_socket_path(args.socket))
+        except IOError as e:
+            log.critical('could not start the daemon: %s', e)
+            sys.exit(1)
+        return
+
     if len(args.args) > 0 and args.commands_pre:
         caasp_cmd.command_line_args(args.args)
 
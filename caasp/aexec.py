@@ -0,0 +1,188 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import asyncio
+import logging
+import os
+import queue
+import signal
+import subprocess
+import threading
+from collections import namedtuple
+
+from .defaults import *
+
+log = logging.getLogger(__name__)
+
+# max length of a line in the output of a process
+# (the Salt output with `--static` comes in a single line)
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# the result of a process run with `run_many()`
+ProcessResult = namedtuple('ProcessResult', ['cmd', 'returncode', 'stdout', 'stderr'])
+
+
+def shell_cmd(cmd):
+    ''' Get the arguments for running a command (a string) with the shell '''
+    if isinstance(cmd, str):
+        return ['/bin/sh', '-c', cmd]
+    return list(cmd)
+
+
+async def _read_lines(stream, cb):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        cb(line.decode('utf-8', 'replace'))
+
+
+async def run_process(cmd, stdout_cb, stderr_cb, timeout=None, stdin=None, env=None):
+    '''
+    Run a process, passing the lines in its stdout and stderr
+    to the callbacks as they arrive, and returning its exit code.
+
+    The process is killed if it does not finish in `timeout` seconds
+    (raising a `subprocess.TimeoutExpired`) or when we are cancelled.
+    The process gets our environment unless some `env` is provided.
+    '''
+    proc = await asyncio.create_subprocess_exec(*shell_cmd(cmd),
+                                                stdin=stdin,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE,
+                                                limit=STREAM_LIMIT,
+                                                env=env,
+                                                start_new_session=True)
+    try:
+        await asyncio.wait_for(asyncio.gather(_read_lines(proc.stdout, stdout_cb),
+                                              _read_lines(proc.stderr, stderr_cb),
+                                              proc.wait()),
+                               timeout)
+    except asyncio.TimeoutError:
+        log.debug('aexec: "%s" timed out after %s secs', cmd, timeout)
+        await _kill(proc)
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    except BaseException:
+        # cancelled (or something went wrong while reading)
+        await _kill(proc)
+        raise
+
+    return proc.returncode
+
+
+async def _kill(proc):
+    # kill the whole group, as the shell can leave children behind
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+class AsyncEngine(object):
+    '''
+    An event loop, running in a background thread, where we run
+    the processes. The synchronous methods can be used from any thread.
+    '''
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name='caaspctl-aexec',
+                                                daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, coro):
+        ''' Run a coroutine in the loop, returning a `concurrent.futures.Future` '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop())
+
+    def stream(self, cmd, timeout=None, stderr_cb=None):
+        '''
+        Run a command, yielding the lines in its standard output.
+        The standard error is passed to `stderr_cb` (in the caller's thread).
+
+        Closing the generator kills the process.
+        '''
+        lines = queue.Queue()
+        future = self.submit(run_process(cmd,
+                                         lambda line: lines.put(('out', line)),
+                                         lambda line: lines.put(('err', line)),
+                                         timeout=timeout))
+        future.add_done_callback(lambda f: lines.put(('done', None)))
+
+        try:
+            while True:
+                kind, line = lines.get()
+                if kind == 'out':
+                    yield line
+                elif kind == 'err':
+                    if stderr_cb:
+                        stderr_cb(line)
+                else:
+                    break
+
+            returncode = future.result()
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, cmd)
+        finally:
+            if not future.done():
+                future.cancel()
+
+    def run_many(self, cmds, timeout=None, max_running=None):
+        '''
+        Run many commands at the same time (`max_running` at most),
+        returning a `ProcessResult` for each one of them (in order).
+        A command that times out gets a `None` return code.
+        '''
+        return self.submit(self._run_many(cmds, timeout, max_running)).result()
+
+    async def _run_many(self, cmds, timeout, max_running):
+        sem = asyncio.Semaphore(max_running or len(cmds) or 1)
+
+        async def run_one(cmd):
+            stdout, stderr = [], []
+            async with sem:
+                try:
+                    returncode = await run_process(cmd, stdout.append, stderr.append,
+                                                   timeout=timeout,
+                                                   stdin=subprocess.DEVNULL)
+                except subprocess.TimeoutExpired:
+                    returncode = None
+            return ProcessResult(cmd, returncode, stdout, ''.join(stderr))
+
+        return await asyncio.gather(*[run_one(cmd) for cmd in cmds])
+
+    def close(self):
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
+                self._thread = None
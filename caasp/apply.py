@@ -24,37 +24,131 @@ import json
 
 from .cmdbase import CmdBase
 from .common import *
-from .errors import OrchestrationFailure
+from .errors import CommandError, OrchestrationFailure
+from .orchestration import OrchestrationJournal, OrchestrationTracker, ProgressLine, \
+    get_excludable, get_requisites
 
 
 class CaaSPApply(CmdBase):
     prompt = prompt('caaspctl:apply')
 
-    def _run_orchestration(self, orch, orch_args='', pillar={}):
+    def _run_orchestration(self, orch, orch_args='', pillar={}, journal=None):
         assert (orch)
         orchestration = orch or ORCH_BOOTSTRAP
 
-        log.info('orchestration: starting "%s"...', orch)
+        if journal is None:
+            journal = OrchestrationJournal(orch, orch_args, pillar)
+            log.info('orchestration: starting "%s" (run %s)...', orch, journal.run_id)
+        else:
+            log.info('orchestration: resuming "%s" (run %s)...', orch, journal.run_id)
 
         if pillar:
             orch_args += ' pillar=\'{}\''.format(
                 json.dumps(pillar, separators=(',', ':')))
 
+        if journal.completed:
+            # skip the states completed in previous attempts (but not the
+            # ones some other state depends on, as they must run again)
+            excludable = self._get_excludable(orch, orch_args, journal.completed)
+            again = [sid for sid in journal.completed if sid not in excludable]
+            if again:
+                log.info('orchestration: %d states already completed must run again, '
+                         'as other states depend on them: %s', len(again), ', '.join(again))
+            if excludable:
+                log.info('orchestration: skipping %d states already completed: %s',
+                         len(excludable), ', '.join(excludable))
+                exclude = [{'id': sid} for sid in excludable]
+                orch_args += ' exclude=\'{}\''.format(json.dumps(exclude, separators=(',', ':')))
+
         if len(orch_args) > 0:
             log.info('orchestration: arguments: %s', orch_args)
 
-        print_iterator(salt_sync())
+        print_iterator(salt_sync(force=self.args.force_sync))
 
         log.info('orchestration: doing %s for real...', orch)
+        debug = log.isEnabledFor(logging.DEBUG)
+        tracker = OrchestrationTracker(orch, progress=None if debug else ProgressLine())
+
+        def on_stderr(data):
+            tracker.feed_log(data)
+            if debug:
+                sys.stderr.write(data)
+
+        journal.attempts += 1
+        journal.save()
+
+        status = 'failed'
         cmd = 'state.orchestrate orch.{orch} {orch_args}'.format(**locals())
         try:
-            for line in exec_salt_runner(cmd, salt_args=ORCH_OPTS):
-                sys.stdout.write(line)
+            for line in exec_salt_runner(cmd, salt_args=ORCH_OPTS, out='json', stderr_cb=on_stderr):
+                tracker.feed_output(line)
+            if not tracker.failed:
+                status = 'finished'
         except Exception as e:
             raise OrchestrationFailure(
                 'orchestration {} failed: {}'.format(orch, e))
-        else:
-            log.info('orchestration: %s finished', orch)
+        finally:
+            tracker.finish()
+            self._report(tracker)
+            journal.record(tracker, status)
+            journal.save()
+            if status != 'finished':
+                log.info('orchestration: it can be resumed with "apply resume %s"', journal.run_id)
+
+        if tracker.failed:
+            raise OrchestrationFailure('orchestration {} failed: {} failed'.format(
+                orch, ', '.join(s.name for s in tracker.failed)))
+
+        log.info('orchestration: %s finished', orch)
+
+    def _get_excludable(self, orch, orch_args, completed):
+        ''' The completed states that can be skipped when resuming an orchestration '''
+        cmd = 'state.orchestrate_show_sls orch.{} {}'.format(orch, orch_args)
+        parser = JSONStreamParser()
+        docs = []
+        try:
+            for line in exec_salt_runner(cmd, salt_args='--log-level=quiet', out='json'):
+                docs.extend(parser.feed(line))
+        except subprocess.CalledProcessError as e:
+            log.debug('orchestration: could not get the states in %s: %s', orch, e)
+
+        high = next((h for h in map(_find_high_data, docs) if h), None)
+        if not high:
+            log.warning('orchestration: could not get the requisites of the states '
+                        'in %s: all the states will run again', orch)
+            return []
+
+        return get_excludable(completed, get_requisites(high))
+
+    def _report(self, tracker):
+        ''' Print the states in the orchestration (sorted by duration) '''
+        rows = []
+        for state in tracker.rows():
+            minions = ','.join(state['minions'])
+            if len(minions) > ORCH_REPORT_MINIONS_WIDTH:
+                minions = minions[:ORCH_REPORT_MINIONS_WIDTH - 3] + '...'
+            rows.append(OrderedDict([('state', state['state']),
+                                     ('function', state['function'] or ''),
+                                     ('result', {True: 'ok', False: 'FAILED'}.get(state['result'], '?')),
+                                     ('secs', '{:.1f}'.format(state['duration'])),
+                                     ('minions', minions)]))
+        print_iterator(format_table(rows))
+
+        report = self.args.orch_report
+        if report:
+            log.info('orchestration: writing report to %s', report)
+            tracker.write_report(report)
+
+    def do_sync(self, line):
+        '''
+        Synchronize the custom Salt modules in all the minions (skipping
+        the targets that have not changed, unless `--force-sync` is used).
+
+        Usage:
+
+        > apply sync [grains modules ...]
+        '''
+        print_iterator(salt_sync(line or 'all', force=self.args.force_sync))
 
     def do_bootstrap(self, line):
         '''
@@ -67,3 +161,65 @@ class CaaSPApply(CmdBase):
         Run the update orchestration.
         '''
         self._run_orchestration(ORCH_UPDATE, line)
+
+    def do_resume(self, line):
+        '''
+        Resume a failed orchestration, skipping the states that were
+        completed successfully (by default, the last orchestration run).
+
+        Note: the completed states that some other state depends on (ie,
+        with a `require`) run again, as Salt cannot satisfy requisites
+        on excluded states.
+
+        Usage:
+
+        > apply resume [RUN_ID]
+        '''
+        run_id = line.strip()
+        if run_id:
+            journal = OrchestrationJournal.load(run_id)
+            if not journal:
+                raise CommandError('no orchestration run "{}" found'.format(run_id))
+        else:
+            journals = OrchestrationJournal.all()
+            if not journals:
+                raise CommandError('no orchestration runs found')
+            journal = journals[-1]
+
+        if journal.status == 'finished':
+            log.info('orchestration: run %s already finished', journal.run_id)
+            return
+
+        self._run_orchestration(journal.orch, journal.orch_args, journal.pillar, journal=journal)
+
+    def do_journal(self, line):
+        '''
+        Print the orchestration runs recorded (that can be resumed).
+
+        Usage:
+
+        > apply journal
+        '''
+        rows = []
+        for journal in OrchestrationJournal.all():
+            rows.append(OrderedDict([('run', journal.run_id),
+                                     ('orchestration', journal.orch),
+                                     ('status', journal.status),
+                                     ('attempts', str(journal.attempts)),
+                                     ('completed', str(len(journal.completed))),
+                                     ('failed', ', '.join(journal.failed))]))
+        print_iterator(format_table(rows))
+
+
+def _find_high_data(doc):
+    # the high data is the `{ID: {'__sls__': ..., module: [...]}}`,
+    # maybe inside a `{master: ...}`
+    if not isinstance(doc, dict) or not doc:
+        return None
+    if all(isinstance(v, dict) and '__sls__' in v for v in doc.values()):
+        return doc
+    for value in doc.values():
+        high = _find_high_data(value)
+        if high:
+            return high
+    return None
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+from .cmdbase import CmdBase
+from .common import *
+from .script import compiled_scripts, forget_compiled_scripts
+
+log = logging.getLogger(__name__)
+
+
+class CaaSPCache(CmdBase):
+    prompt = prompt('caaspctl:cache')
+
+    def do_stats(self, line):
+        '''
+        Print some statistics about the grains cache.
+
+        Usage:
+
+        > cache stats
+        '''
+        for k, v in get_grain_cache().stats().items():
+            print('{}: {}'.format(k, v))
+        print('roles-index: {}'.format('cached' if roles_index_cached() else 'not cached'))
+        print('compiled-scripts: {}'.format(compiled_scripts()))
+
+    def do_clear(self, line):
+        '''
+        Forget all the grains in the cache (and the roles index),
+        so they are obtained again from the minions, and the
+        compiled scripts.
+
+        Usage:
+
+        > cache clear
+        '''
+        log.info('Clearing the grains cache')
+        get_grain_cache().clear()
+        forget_roles_index()
+        forget_compiled_scripts()
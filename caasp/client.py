@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+'''
+A thin client for a `caaspctl --serve` daemon: it sends the commands
+(or scripts) to the daemon and prints the output it gets back, so
+nothing else must be imported (this can be run with `python -m caasp.client`).
+'''
+
+import json
+import os
+import socket
+import sys
+
+from .defaults import *
+
+
+def get_socket_path(path=None):
+    ''' The path of the daemon socket '''
+    if path:
+        return path
+    if os.environ.get(SERVER_SOCKET_ENV):
+        return os.environ[SERVER_SOCKET_ENV]
+
+    from .state import get_state_dir
+    d = get_state_dir()
+    if not d:
+        raise IOError('no state directory where the socket could be: use --socket')
+    return os.path.join(d, SERVER_SOCKET_FILE)
+
+
+def run_client(path, commands=None, scripts=None):
+    '''
+    Run some commands (a list of words, as in the command line) and scripts
+    in the daemon listening at `path`, returning the exit status.
+    '''
+    request = {'commands': commands or [],
+               'scripts': [os.path.abspath(s) for s in scripts or []],
+               'cwd': os.getcwd(),
+               'env': dict(os.environ)}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sys.stderr.write('caaspctl: could not connect to the daemon at {}: {}\n'.format(path, e))
+        return 2
+
+    with sock, sock.makefile('rb') as replies:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for reply in replies:
+            msg = json.loads(reply.decode('utf-8'))
+            if 'out' in msg:
+                sys.stdout.write(msg['out'])
+                sys.stdout.flush()
+            elif 'err' in msg:
+                sys.stderr.write(msg['err'])
+                sys.stderr.flush()
+            elif 'exit' in msg:
+                return msg['exit']
+
+    sys.stderr.write('caaspctl: the daemon closed the connection\n')
+    return 2
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run some commands in a caaspctl daemon')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='commands to run')
+    parser.add_argument('--socket', metavar='PATH', default=None,
+                        help='the socket of the daemon (default: ${} or {} in the state directory)'.format(
+                            SERVER_SOCKET_ENV, SERVER_SOCKET_FILE))
+    parser.add_argument('--script', metavar='FILE', action='append', default=[],
+                        help='run the commands in a script (can be repeated)')
+    args = parser.parse_args()
+
+    try:
+        path = get_socket_path(args.socket)
+    except IOError as e:
+        parser.error(str(e))
+    sys.exit(run_client(path, args.args, args.script))
+
+
+if __name__ == '__main__':
+    main()
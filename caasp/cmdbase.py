@@ -20,13 +20,53 @@
 #   - Alvaro Saurin <alvaro.saurin@suse.com>
 #
 
+import io
 import os
 import glob as gb
+import threading
 import traceback
 from cmd import Cmd
+from concurrent.futures import ThreadPoolExecutor
 
 from .common import *
 from .errors import CommandError
+from .script import LET_RE, ScriptCommand, ScriptReader, compile_script
+from .trace import trace_span
+
+
+# state of the current thread when running a command in a parallel block
+_worker = threading.local()
+
+
+# the arguments of a `let`
+LET_VALUE_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)$')
+
+
+def in_parallel_worker():
+    return getattr(_worker, 'active', False)
+
+
+class ThreadOutput(object):
+    '''
+    A replacement for `sys.stdout` that buffers the output
+    of the commands running in parallel blocks.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, txt):
+        output = getattr(_worker, 'output', None)
+        if output is None:
+            return self.stream.write(txt)
+        return output.write(txt)
+
+    def flush(self):
+        if getattr(_worker, 'output', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 
 def complete_path(path):
@@ -48,6 +88,17 @@ class CmdBase(Cmd):
         self.blocked = False
         self.current_script = ''
         self.top = top
+        self.parallel_block = None
+        self.parallel_max = PARALLEL_MAX_WORKERS
+        # the variables set with `let`, and the output of the shell
+        # commands run in the current script (`None` when not in a script)
+        self.variables = OrderedDict()
+        self.shell_outputs = None
+
+    @property
+    def session(self):
+        ''' The top command processor, where the variables are kept '''
+        return self.top.session if self.top else self
 
     def abort(self):
         self.do_traceback('')
@@ -66,22 +117,35 @@ class CmdBase(Cmd):
             self.onecmd(command)
 
     def onecmd(self, line):
+        if self.parallel_block is not None and not self.blocked:
+            return self._collect_parallel(line)
+
         try:
             if not self.blocked or line == 'EOF' or line.startswith('stage'):
-                return Cmd.onecmd(self, line)
+                with trace_span(line.strip(), 'command'):
+                    return Cmd.onecmd(self, line)
             else:
                 return False
         except subprocess.CalledProcessError as e:
+            if in_parallel_worker():
+                raise
             log.info(on_color('RED', 'Command error: ' + str(e)))
             if self.args.exit_on_err or not self.is_interactive():
                 self.abort()
         except KeyboardInterrupt as e:
+            if in_parallel_worker():
+                raise
             log.info(on_color('RED', '[interrupted]'))
             if self.args.exit_on_err or not self.is_interactive():
                 self.last_exc = sys.exc_info()
                 self.abort()
 
     def cmdloop(self, intro=None):
+        if self.use_rawinput and self.completekey:
+            # readline is only needed (and imported) when reading from a terminal
+            import readline
+            readline.set_completer_delims(' \t\n')
+
         if self.intro:
             print(self.intro)
 
@@ -113,34 +177,52 @@ class CmdBase(Cmd):
                     on_color('RED', 'get more details with "traceback".'))
 
     def precmd(self, line):
+        if getattr(self.stdin, 'compiled', False):
+            return line  # (the substitutions have been done when reading it)
+
         if line.lstrip().startswith('#'):
             return ''
 
-        if len(line.strip()) == 0:
+        if len(line.strip()) == 0 or LET_RE.match(line):
             return line
 
         # replace all the `some-shell-command`
-        def sh_replacer(text):
-            cmd = text[1:-1]  # remove the ``
-            log.debug('replacing %s by shell output', cmd)
-            out = subprocess.check_output(
-                cmd, stderr=subprocess.STDOUT, shell=True)
-            return out.decode('utf-8').rstrip()
-
-        line = replace_pattern(r"`.*`", sh_replacer, line)
+        line = replace_pattern(r"`.*`", self._shell_replacer, line)
 
         # replace all the {% some-python-code %}
-        def python_replacer(text):
-            code = text[2:-2]  # remove the {%%}
-            log.debug('replacing %s by python evaluation', code)
-            return str(self.eval(code))
-
-        line = replace_pattern(r"\{\%.*\%\}", python_replacer, line)
+        line = replace_pattern(r"\{\%.*\%\}", self._python_replacer, line)
 
-        line = expandvars(line)
+        line = expandvars(line, self.session.variables)
 
         return line
 
+    def _shell_replacer(self, text, refresh=False):
+        cmd = text[1:-1]  # remove the ``
+
+        # in scripts, identical commands are run only once
+        outputs = self.session.shell_outputs
+        if outputs is not None and not refresh and cmd in outputs:
+            log.debug('replacing %s by (previous) shell output', cmd)
+            return outputs[cmd]
+
+        log.debug('replacing %s by shell output', cmd)
+        out = subprocess.check_output(
+            cmd, stderr=subprocess.STDOUT, shell=True)
+        out = out.decode('utf-8').rstrip()
+        if outputs is not None:
+            outputs[cmd] = out
+        return out
+
+    def _python_replacer(self, text):
+        code = text[2:-2]  # remove the {%%}
+        log.debug('replacing %s by python evaluation', code)
+        return str(self.eval(code))
+
+    def render_command(self, command):
+        ''' Get the line for a command in a compiled script '''
+        return command.render(self._shell_replacer, self._python_replacer,
+                              self.session.variables)
+
     def default(self, line):
         line = line.lstrip()
 
@@ -182,19 +264,24 @@ class CmdBase(Cmd):
         self.intro = ''
         self.current_script = os.path.abspath(script)
 
+        session = self.session
+        outermost = session.shell_outputs is None
+        if outermost:
+            session.shell_outputs = {}
+
         try:
-            with open(script, 'rt') as script_fd:
-                self.stdin = script_fd
-                self.cmdloop()
+            commands = compile_script(script, cached=not self.args.no_script_cache)
+            self.stdin = ScriptReader(commands, self)
+            self.cmdloop()
         finally:
-            script_fd.close()
-
             # restore the previous settings
             self.stdin = old_stdin
             self.prompt = old_prompt
             self.intro = old_intro
             self.use_rawinput = old_use_rawinput
             self.current_script = ''
+            if outermost:
+                session.shell_outputs = None
 
     def do_load(self, line):
         '''
@@ -263,16 +350,184 @@ class CmdBase(Cmd):
         return self.do_EOF(line)
 
     def eval(self, code):
-        gl = globals()
-        return eval(code, {'root': gl['caasp_cmd']}, {})
+        variables = self.session.variables
+        gl = dict(variables)
+        gl.update({'root': self.session, 'variables': variables})
+        return eval(code, gl, {})
 
     def do_eval(self, line):
         print(self.eval(line))
 
+    def do_let(self, line):
+        '''
+        Set a variable, that can be used in the next commands as $NAME
+        (or ${NAME}) and as NAME in the {% %} expressions.
+
+        The shell commands in a script are run only once, and their
+        output is reused in the next commands: "let!" runs them again.
+
+        Usage:
+
+        > let MASTER = `cat /etc/machine-id`
+        > let NUM = {% 2 * 3 %}
+        > let! MASTER = `cat /etc/machine-id`
+        > roles set $MASTER kube-master
+        > let
+        '''
+        line = line.strip()
+        refresh = line.startswith('!')
+        if refresh:
+            line = line[1:].strip()
+
+        variables = self.session.variables
+        if not line:
+            for name, value in variables.items():
+                print('{} = {}'.format(name, value))
+            return
+
+        m = LET_VALUE_RE.match(line)
+        if not m:
+            raise CommandError('"let" requires a NAME = VALUE')
+
+        name, value = m.group(1), m.group(2).strip()
+        command = ScriptCommand.parse(0, value)
+        if command.python == (0, len(value)):
+            # keep the (Python) type of the value
+            value = self.eval(value[2:-2])
+        else:
+            value = command.render(lambda text: self._shell_replacer(text, refresh=refresh),
+                                   self._python_replacer, variables)
+
+        log.debug('let: %s = %s', name, value)
+        variables[name] = value
+
     def emptyline(self):
         # ignore empty lines instead of repeating last command
         pass
 
+    def do_parallel(self, line):
+        '''
+        Start a block of commands that will be run in parallel.
+
+        The commands are run (at most MAX at a time) when the block is
+        closed with "end", and their output is printed when all of them
+        have finished, prefixed with the command number.
+
+        Usage:
+
+        > parallel [MAX]
+        > roles set 5dbc5880c5284d6a8df0813aaa975bf9 kube-master
+        > roles set 2cbd5e93c71c4d2c81ef0ea9a2b0d3e1 kube-minion
+        > config set api:server:external_fqdn 192.168.122.4
+        > end
+        '''
+        if in_parallel_worker():
+            raise CommandError('parallel blocks cannot be nested')
+
+        line = line.strip()
+        self.parallel_max = int(line) if line else self.args.max_parallel
+        if self.parallel_max < 1:
+            raise CommandError('invalid number of parallel commands')
+        self.parallel_block = []
+
+    def do_end(self, line):
+        '''
+        End a parallel block.
+        '''
+        raise CommandError('"end" found without a "parallel"')
+
+    def _collect_parallel(self, line):
+        command = line.strip()
+        if command == 'EOF':
+            log.error('parallel block not closed with "end"')
+        elif command.split(' ')[0] == 'parallel':
+            self.parallel_block = None
+            raise CommandError('parallel blocks cannot be nested')
+        elif command != 'end':
+            if command:
+                self.parallel_block.append(command)
+            return False
+
+        commands, self.parallel_block = self.parallel_block, None
+        self.run_parallel(commands, self.parallel_max)
+        return Cmd.onecmd(self, line) if command == 'EOF' else False
+
+    def run_parallel(self, commands, max_workers):
+        '''
+        Run some commands in parallel, printing their (buffered) output
+        when all of them have finished.
+        '''
+        if not commands:
+            return
+
+        log.info('parallel: running %d commands (%d at a time)',
+                 len(commands), max_workers)
+
+        results = [None] * len(commands)
+        failed = threading.Event()
+
+        def worker(idx, command):
+            if failed.is_set() and self.args.exit_on_err:
+                return  # do not start new commands after an error
+
+            _worker.active = True
+            _worker.output = io.StringIO()
+            start = time.time()
+            error = None
+            try:
+                self.onecmd(command)
+            except BaseException as e:
+                error = sys.exc_info()
+                failed.set()
+            finally:
+                output = _worker.output.getvalue()
+                _worker.active = False
+                _worker.output = None
+
+            results[idx] = (output, error, time.time() - start)
+
+        old_stdout = sys.stdout
+        sys.stdout = ThreadOutput(old_stdout)
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(worker, idx, command)
+                           for idx, command in enumerate(commands)]
+                try:
+                    for future in futures:
+                        future.result()
+                except KeyboardInterrupt:
+                    # do not start the commands still waiting
+                    # (the ones already running are left to finish)
+                    log.warning('parallel: interrupted: cancelling %d commands not started',
+                                len([f for f in futures if not f.running() and not f.done()]))
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        finally:
+            sys.stdout = old_stdout
+
+        errors = 0
+        for idx, (command, result) in enumerate(zip(commands, results), 1):
+            if result is None:
+                log.warning(on_color('RED', 'parallel: [%d] "%s" cancelled'), idx, command)
+                continue
+
+            output, error, elapsed = result
+            for output_line in output.splitlines():
+                sys.stdout.write('[{}] {}\n'.format(idx, output_line))
+
+            if error:
+                errors += 1
+                self.last_exc = error
+                log.error(on_color('RED', 'parallel: [%d] "%s" failed after %.2f secs: %s'),
+                          idx, command, elapsed, error[1])
+            else:
+                log.info('parallel: [%d] "%s" finished in %.2f secs', idx, command, elapsed)
+
+        if errors:
+            log.error(on_color('RED', 'parallel: %d/%d commands failed'), errors, len(commands))
+            if self.args.exit_on_err or not self.is_interactive():
+                self.abort()
+
     def do_stage(self, line):
         '''
         Mark the beginning of a new stage.
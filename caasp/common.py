@@ -19,26 +19,57 @@
 #   - Alvaro Saurin <alvaro.saurin@suse.com>
 #
 
+import errno
+import hashlib
+import json
 import logging
 import os
 import re
-import readline
+import shlex
+import signal
 import subprocess
 import sys
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from .defaults import *
-from .errors import CommandError, ContainerWaitTimeout, ContainerNotFoundException
+from .db import DBPool, ERROR_ACCESS_DENIED, ERROR_RE, format_sql, parse_batch_output, sql_quote
+from .errors import CommandError, ContainerWaitTimeout, ContainerNotFoundException, DBError, DockerEngineError, \
+    SaltClientError
+from .graincache import ALL_GRAINS, GrainCache
+from .saltret import JSONStreamParser, SaltResult, STATUS_MISSING, STATUS_OK
+from .state import load_state, save_state
+from .trace import traced, traced_sleep, tracer
 
-readline.set_completer_delims(' \t\n')
 log = logging.getLogger(__name__)
 
 
-def execute(cmd, sudo=False, password=None):
-    ''' Execute a command '''
+_async_engine = None
+
+
+def get_async_engine():
+    ''' Get the (shared) engine used for running processes '''
+    global _async_engine
+    if _async_engine is None:
+        from .aexec import AsyncEngine  # (asyncio is slow to import)
+        _async_engine = AsyncEngine()
+    return _async_engine
+
+
+@traced('exec')
+def execute(cmd, sudo=False, password=None, timeout=None, stderr_cb=None):
+    '''
+    Execute a command, yielding the lines in its output. The standard
+    error is passed to `stderr_cb` (or printed), and every line in `cmd`
+    is killed if it takes more than `timeout` seconds.
+    '''
     assert (isinstance(cmd, str))
 
+    if stderr_cb is None:
+        stderr_cb = sys.stderr.write
+
     for line in cmd.splitlines():
         line = line.strip()
         if not line:
@@ -53,15 +84,142 @@ def execute(cmd, sudo=False, password=None):
             cmd = line
 
         log.debug('Running "%s"', cmd)
-        popen = subprocess.Popen(
-            cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True)
-        for stdout_line in iter(popen.stdout.readline, ""):
+        for stdout_line in get_async_engine().stream(cmd, timeout=timeout, stderr_cb=stderr_cb):
             yield stdout_line
 
-        popen.stdout.close()
-        return_code = popen.wait()
-        if return_code:
-            raise subprocess.CalledProcessError(return_code, cmd)
+
+def execute_many(cmds, timeout=None, max_running=None):
+    '''
+    Execute many commands at the same time, returning
+    a `ProcessResult` (with the output) for each one of them
+    '''
+    for cmd in cmds:
+        log.debug('Running "%s"', cmd)
+    return get_async_engine().run_many(cmds, timeout=timeout, max_running=max_running)
+
+
+def get_raw_output():
+    '''
+    The file descriptor where the output of a process can be copied as
+    it is (or `None` when it must go through `sys.stdout`, like in parallel
+    blocks, where the output is buffered, or in the daemon, where it is
+    sent to the client)
+    '''
+    if sys.stdout is not sys.__stdout__:
+        return None
+    try:
+        return sys.stdout.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def copy_raw(src, dst, chunk_size=RAW_CHUNK_SIZE):
+    '''
+    Copy everything in the pipe `src` to the file descriptor `dst`,
+    yielding the number of bytes copied in every chunk. The data is
+    moved in the kernel (with `splice()`) when `dst` supports it.
+    '''
+    splice = getattr(os, 'splice', None)
+    while True:
+        if splice:
+            try:
+                n = splice(src, dst, chunk_size)
+            except OSError as e:
+                if e.errno not in [errno.EINVAL, errno.ENOSYS]:
+                    raise
+                # `dst` cannot be spliced (ie, a terminal or a file in append mode)
+                splice = None
+                continue
+        else:
+            data = os.read(src, chunk_size)
+            _write_all(dst, data)
+            n = len(data)
+
+        if not n:
+            break
+        yield n
+
+
+@traced('exec')
+def execute_raw(cmd, out, stderr_cb=None):
+    '''
+    Execute a command, copying its output to the file descriptor `out`
+    as it is (without decoding it or splitting it in lines), and yielding
+    the number of bytes copied. The standard error is passed to `stderr_cb`
+    (or it goes to our standard error).
+    '''
+    log.debug('Running "%s" (raw output)', cmd)
+    # (anything we have printed must go before)
+    sys.stdout.flush()
+    proc = subprocess.Popen(cmd,
+                            shell=True,
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE if stderr_cb else None,
+                            start_new_session=True)
+
+    stderr_thread = None
+    if stderr_cb:
+        def read_stderr():
+            for line in proc.stderr:
+                stderr_cb(line.decode('utf-8', 'replace'))
+
+        stderr_thread = threading.Thread(target=read_stderr, daemon=True)
+        stderr_thread.start()
+
+    try:
+        for n in copy_raw(proc.stdout.fileno(), out):
+            yield n
+        proc.wait()
+    finally:
+        if proc.poll() is None:
+            # (ie, we have been interrupted: kill the whole group, as in aexec)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+        if stderr_thread:
+            stderr_thread.join()
+        proc.stdout.close()
+
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+class ProcessOutput(object):
+    '''
+    The output of a process that is started immediately and
+    that can be stopped (with `close()`) at any time.
+    '''
+
+    def __init__(self, cmd, parser=None):
+        log.debug('Starting "%s"', ' '.join(cmd))
+        self.parser = parser
+        self.popen = subprocess.Popen(cmd,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL,
+                                      universal_newlines=True)
+
+    def __iter__(self):
+        for line in iter(self.popen.stdout.readline, ''):
+            if self.parser:
+                line = self.parser(line)
+                if line is None:
+                    continue
+            yield line
+
+    def close(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+        self.popen.stdout.close()
+        self.popen.wait()
 
 
 def execute_interactive(cmd, sudo=False, password=None):
@@ -75,6 +233,7 @@ def execute_interactive(cmd, sudo=False, password=None):
     return subprocess.call(cmd, shell=True)
 
 
+@traced('exec')
 def execute_now(cmd, strip_nls=True):
     res = []
     for line in cmd.splitlines():
@@ -82,7 +241,7 @@ def execute_now(cmd, strip_nls=True):
         if not line:
             continue
 
-        out = str(subprocess.check_output(line, shell=True))
+        out = subprocess.check_output(line, shell=True).decode('utf-8')
         if strip_nls:
             out = out.strip('\n')
 
@@ -98,7 +257,78 @@ def execute_now(cmd, strip_nls=True):
 # Containers
 #########################
 
+# the Docker Engine client: `None` when not available/disabled, `False` when not checked yet
+_docker_engine = False
+_docker_engine_enabled = True
+
+# cache of containers IDs, as `container name -> (ID, expiration time)`
+_containers_cache = {}
+
+# containers we have already seen running (so we do not need to wait for them)
+_containers_ready = set()
+
+
+def set_docker_engine(enabled):
+    ''' Enable/disable the use of the Docker Engine API '''
+    global _docker_engine, _docker_engine_enabled
+    _docker_engine_enabled = enabled
+    _docker_engine = False
+
+
+def set_docker_host(host):
+    '''
+    Run the containers commands in the Docker Engine at `host` (a `DOCKER_HOST`,
+    like `unix:///path/docker.sock`, `tcp://admin:2376` or `ssh://root@admin`)
+    '''
+    global _docker_engine
+    # (the "docker" CLI we run, here or in db.py/salthelper.py, gets it from the environment)
+    os.environ['DOCKER_HOST'] = host
+    _docker_engine = False
+    flush_containers_cache()
+
+
+def is_remote_docker_host():
+    ''' True when the containers are in a Docker Engine that is not a local socket '''
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    return bool(docker_host) and not docker_host.startswith('unix://')
+
+
+def get_docker_engine():
+    ''' Get a client for the Docker Engine API (or `None` if we must use the CLI) '''
+    global _docker_engine
+    if not _docker_engine_enabled:
+        return None
+
+    if _docker_engine is False:
+        path = DOCKER_SOCKET
+        docker_host = os.environ.get('DOCKER_HOST', '')
+        if is_remote_docker_host():
+            log.debug('docker-api: DOCKER_HOST=%s: using the CLI', docker_host)
+            _docker_engine = None
+            return None
+        elif docker_host:
+            path = docker_host[len('unix://'):]
+
+        from .docker_api import DockerEngine  # (http.client is slow to import)
+        engine = DockerEngine(path)
+        if engine.is_available():
+            log.debug('docker-api: using the Docker Engine at %s', path)
+            _docker_engine = engine
+        else:
+            _docker_engine = None
+
+    return _docker_engine
+
+
 def get_regular_container(name):
+    engine = get_docker_engine()
+    if engine:
+        try:
+            return engine.find_container(name)
+        except DockerEngineError as e:
+            log.debug('docker-api: could not list containers: %s', e)
+            set_docker_engine(False)
+
     docker_ps_out = execute_now('docker ps')
     for line in docker_ps_out.split('\n'):
         fields = re.split('\s{2,}', line.strip())
@@ -114,43 +344,204 @@ def get_container(name):
     return get_regular_container("k8s_{name}_velum".format(name=name))
 
 
-def get_cid(name):
-    ''' Get the real container for an 'alias' (like 'db' or 'salt') '''
+def get_container_name(name):
+    ''' Get the (partial) container name for an 'alias' (like 'db' or 'salt') '''
     if name in ['salt-master', 'salt']:
-        return get_container(CONTAINER_SALT_MASTER)
+        return CONTAINER_SALT_MASTER
     elif name in ['velum']:
-        return get_container(CONTAINER_VELUM)
+        return CONTAINER_VELUM
     elif name in ['mariadb', 'mysql', 'maria', 'db']:
-        return get_container(CONTAINER_MARIADB)
+        return CONTAINER_MARIADB
     elif name in ['api', 'salt-api', 'API']:
-        return get_container(CONTAINER_SALT_API)
+        return CONTAINER_SALT_API
     elif name in ['ldap', 'openldap']:
-        return get_container(CONTAINER_OPENLDAP)
+        return CONTAINER_OPENLDAP
     else:
-        return get_container(name)
+        return name
+
+
+def get_cid(name, cached=True):
+    ''' Get the real container for an 'alias' (like 'db' or 'salt') '''
+    cname = get_container_name(name)
+
+    if cached:
+        try:
+            cid, expiration = _containers_cache[cname]
+            if datetime.now() <= expiration:
+                return cid
+        except KeyError:
+            pass
+
+    cid = get_container(cname)
+    if cid:
+        log.debug('containers cache: %s -> %s', cname, cid)
+        _containers_cache[cname] = (
+            cid, datetime.now() + timedelta(seconds=CONTAINER_CACHE_TTL))
+    else:
+        forget_container(name)
+
+    return cid
+
+
+def forget_container(name):
+    ''' Remove a container from the cache (ie, because it has been restarted) '''
+    cname = get_container_name(name)
+    _containers_cache.pop(cname, None)
+    _containers_ready.discard(cname)
+
+
+def flush_containers_cache():
+    ''' Forget about all the containers we know about '''
+    _containers_cache.clear()
+    _containers_ready.clear()
+
+
+def watch_containers_started(timeout):
+    '''
+    Start watching the containers started in the next `timeout` seconds,
+    returning an iterator with their names, that must be `close()`d
+    (or `None` if we cannot watch the Docker events)
+    '''
+    engine = get_docker_engine()
+    if engine:
+        filters = {'type': ['container'], 'event': ['start']}
+        try:
+            return engine.events(filters=filters,
+                                 until=time.time() + timeout,
+                                 parser=lambda event: event.get('Actor', {}).get('Attributes', {}).get('name', ''))
+        except DockerEngineError as e:
+            log.debug('docker-api: cannot watch events: %s', e)
+            return None
+
+    cmd = ['docker', 'events',
+           '--filter', 'type=container',
+           '--filter', 'event=start',
+           # (a duration would be relative to *now* and in the past)
+           '--until', str(int(time.time() + timeout)),
+           '--format', '{{.Actor.Attributes.name}}']
+    try:
+        return ProcessOutput(cmd, parser=lambda line: line.strip())
+    except OSError as e:
+        log.debug('docker: cannot watch events: %s', e)
+        return None
 
 
 def wait_for_container(name, timeout=CONTAINER_START_TIMEOUT):
     '''Wait for a container to be up and running'''
+    cname = get_container_name(name)
+    if cname in _containers_ready and get_cid(name):
+        log.debug('container %s is known to be running', name)
+        return
+
+    def is_running(cached=True):
+        try:
+            cid = get_cid(name, cached=cached)
+        except Exception:
+            return False
+
+        if cid:
+            log.debug('container %s is running with ID %s', name, cid)
+            _containers_ready.add(cname)
+        return bool(cid)
+
     timeout_limit = datetime.now() + timedelta(seconds=timeout)
-    while datetime.now() <= timeout_limit:
+
+    if is_running():
+        return
+
+    # subscribe to the Docker events and check the container again,
+    # so we do not miss it if it is started in between
+    events = watch_containers_started(timeout)
+    if events is not None:
         try:
-            cid = get_cid(name)
-            if cid:
-                log.debug('container %s is running with ID %s', name, cid)
+            if is_running(cached=False):
                 return
-        except:
-            pass
+
+            log.debug('docker: waiting for "%s" to be started...', name)
+            container_name = 'k8s_{}_velum'.format(cname)
+            for started in events:
+                if container_name in started and is_running(cached=False):
+                    return
+        except Exception as e:
+            log.debug('docker: could not watch events: %s', e)
+        finally:
+            events.close()
+
+    # fallback to polling (for the time left)
+    while datetime.now() <= timeout_limit:
+        if is_running():
+            return
 
         log.debug('docker: waiting for "{}" ({} left)...'.format(
             name, timeout_limit - datetime.now()))
-        time.sleep(5)
+        traced_sleep(5, 'wait_for_container')
+
+    # (a last check, in case we have missed it)
+    if is_running(cached=False):
+        return
 
     raise ContainerWaitTimeout('timeout while waiting for {}'.format(name))
 
 
-def exec_in_container(name, cmd, wait=False):
-    ''' Run a command in a container '''
+@traced('docker')
+def exec_in_container(name, cmd, wait=False, stderr_cb=None):
+    ''' Run a command in a container (passing its stderr to `stderr_cb`) '''
+    c = _find_cid(name, wait)
+
+    log.debug('docker: executing in "%s" command "%s"', c, cmd)
+    produced = False
+    try:
+        for line in _exec_in_cid(c, cmd, stderr_cb):
+            if line:
+                produced = True
+                yield line
+    except subprocess.CalledProcessError:
+        # maybe the command failed because the container is gone
+        # (ie, it has been restarted): check if it has a new ID and,
+        # if nothing has been produced yet, try again in the new container
+        new_c = get_cid(name, cached=False)
+        if produced or not new_c or new_c == c:
+            if not new_c:
+                raise ContainerNotFoundException(
+                    'container {name} is gone'.format(name=name))
+            raise
+
+        log.debug('docker: container %s was replaced by %s: retrying', c, new_c)
+        for line in _exec_in_cid(new_c, cmd, stderr_cb):
+            if line:
+                yield line
+
+
+@traced('docker')
+def exec_in_container_raw(name, cmd, out, wait=False, stderr_cb=None):
+    '''
+    Run a command in a container, copying its output to the file descriptor
+    `out` as it is (for big outputs that are just printed), and yielding
+    the number of bytes copied
+    '''
+    c = _find_cid(name, wait)
+
+    log.debug('docker: executing in "%s" command "%s" (raw output)', c, cmd)
+    produced = False
+    try:
+        for n in _exec_in_cid_raw(c, cmd, out, stderr_cb):
+            produced = True
+            yield n
+    except subprocess.CalledProcessError:
+        # (see exec_in_container())
+        new_c = get_cid(name, cached=False)
+        if produced or not new_c or new_c == c:
+            if not new_c:
+                raise ContainerNotFoundException(
+                    'container {name} is gone'.format(name=name))
+            raise
+
+        log.debug('docker: container %s was replaced by %s: retrying', c, new_c)
+        for n in _exec_in_cid_raw(new_c, cmd, out, stderr_cb):
+            yield n
+
+
+def _find_cid(name, wait=False):
     if wait:
         wait_for_container(name)
 
@@ -163,12 +554,42 @@ def exec_in_container(name, cmd, wait=False):
     if not c:
         raise ContainerNotFoundException(
             'could not find container {name}'.format(name=name))
+    return c
 
-    cmd = 'docker exec {} {}'.format(c, cmd)
-    log.debug('docker: executing in "%s" command "%s"', c, cmd)
-    for line in execute(cmd):
-        if line:
+
+def _exec_in_cid(cid, cmd, stderr_cb=None):
+    engine = get_docker_engine()
+    if not engine:
+        return execute('docker exec {} {}'.format(cid, cmd), stderr_cb=stderr_cb)
+
+    return _exec_in_cid_with_engine(engine, cid, cmd, stderr_cb)
+
+
+def _exec_in_cid_raw(cid, cmd, out, stderr_cb=None):
+    engine = get_docker_engine()
+    if not engine:
+        return execute_raw('docker exec {} {}'.format(cid, cmd), out, stderr_cb=stderr_cb)
+
+    return _exec_in_cid_with_engine_raw(engine, cid, cmd, out, stderr_cb)
+
+
+def _exec_in_cid_with_engine_raw(engine, cid, cmd, out, stderr_cb=None):
+    # (the API multiplexes stdout and stderr in frames, so we cannot splice it)
+    sys.stdout.flush()
+    try:
+        for data in engine.exec_in_container(cid, cmd, stderr_cb=stderr_cb or sys.stderr.write, raw=True):
+            _write_all(out, data)
+            yield len(data)
+    except DockerEngineError as e:
+        raise subprocess.CalledProcessError(e.exit_code or 1, cmd)
+
+
+def _exec_in_cid_with_engine(engine, cid, cmd, stderr_cb=None):
+    try:
+        for line in engine.exec_in_container(cid, cmd, stderr_cb=stderr_cb or sys.stderr.write):
             yield line
+    except DockerEngineError as e:
+        raise subprocess.CalledProcessError(e.exit_code or 1, cmd)
 
 
 # TODO: how to invoke a rake task??
@@ -185,34 +606,141 @@ def exec_rake_task(task, *args, **kargs):
 #########################
 
 
-def get_db_password(filename=DB_PASSWORD_FILE):
+# the database password (only kept in memory)
+_db_password = None
+
+# pool of database sessions (`None` when disabled)
+_db_pool = DBPool()
+
+
+def get_db_password(filename=DB_PASSWORD_FILE, cached=True):
     ''' Get the database password '''
+    global _db_password
+    if cached and _db_password:
+        return _db_password
+
     cmd = 'cat ' + filename
     for line in exec_in_container('db', cmd, wait=True):
-        return line.strip()  # return only the first line
+        _db_password = line.strip()  # return only the first line
+        tracer.register_secret(_db_password)
+        return _db_password
 
 
+def forget_db_password():
+    ''' Forget the database password (so it is read again in the next query) '''
+    global _db_password
+    _db_password = None
+
+
+@traced('db')
 def exec_sql_in_db(cmd, **kwargs):
     ''' Run a SQL command in the database '''
     password = get_db_password()
-    log.debug('Using password %s', password)
-    cmd = 'mysql -uroot -p\'{password}\' -B -t -e "{cmd}" {db}'.format(
-        cmd=cmd, db=DB_NAME, password=password)
+    stderr_cb = kwargs.pop('stderr_cb', None) or sys.stderr.write
+    errors = []
+
+    def on_stderr(line):
+        errors.append(line)
+        stderr_cb(line)
+
+    produced = False
+    try:
+        for line in _exec_sql_with_password(cmd, password, stderr_cb=on_stderr, **kwargs):
+            produced = True
+            yield line
+    except subprocess.CalledProcessError:
+        # maybe the command failed because the password has been changed:
+        # read it again and, if it is different, retry the command
+        # (but never retry some SQL that failed for any other reason)
+        codes = [int(m.group(1)) for m in map(ERROR_RE.match, errors) if m]
+        if produced or ERROR_ACCESS_DENIED not in codes:
+            raise
+
+        forget_db_password()
+        new_password = get_db_password()
+        if new_password == password:
+            raise
+
+        log.debug('the database password has changed: retrying')
+        for line in _exec_sql_with_password(cmd, new_password, stderr_cb=stderr_cb, **kwargs):
+            yield line
+
+
+def _exec_sql_with_password(cmd, password, table=True, **kwargs):
+    cmd = 'mysql -uroot -p\'{password}\' -B {table} -e "{cmd}" {db}'.format(
+        cmd=shell_dquote(cmd), db=DB_NAME, password=password,
+        table='-t' if table else '--column-names')
     for line in exec_in_container('db', cmd, **kwargs):
         yield line
 
 
+def set_db_pool(enabled):
+    ''' Enable/disable the use of long-lived database sessions '''
+    global _db_pool
+    if _db_pool:
+        _db_pool.close()
+    _db_pool = DBPool() if enabled else None
+
+
+@traced('db')
+def db_query(sql, params=None, as_dict=False, wait=False):
+    '''
+    Run some SQL in the database, returning the rows (as tuples or,
+    with `as_dict`, as dicts) obtained in the last statement.
+
+    `params` replace the `%s` placeholders in the SQL.
+    '''
+    if wait:
+        wait_for_container('db')
+
+    if _db_pool:
+        try:
+            return _db_query_in_session(sql, params, as_dict)
+        except OSError as e:
+            log.debug('db: could not start a database session (%s): using the CLI', e)
+            set_db_pool(False)
+
+    sql = format_sql(sql, params)
+    return parse_batch_output(exec_sql_in_db(sql, table=False), as_dict=as_dict)
+
+
+def _db_query_in_session(sql, params, as_dict):
+    for attempt in [1, 2]:
+        cid = get_cid('db')
+        if not cid:
+            raise ContainerNotFoundException('could not find container db')
+
+        session = _db_pool.acquire(cid, get_db_password())
+        try:
+            rows = session.execute(sql, params, as_dict=as_dict)
+        except DBError as e:
+            # (we do not know what is left unread in the session)
+            session.close()
+            if e.code not in [None, ERROR_ACCESS_DENIED] or attempt == 2:
+                raise
+
+            # the session died: maybe the password has been changed
+            # or the container has been replaced
+            log.debug('db: database session failed (%s): retrying', e)
+            if e.code == ERROR_ACCESS_DENIED:
+                forget_db_password()
+            get_cid('db', cached=False)
+            continue
+
+        _db_pool.release(session)
+        return rows
+
+
 def wait_for_db(db=None, timeout=CONTAINER_START_TIMEOUT):
     ''' Wait for a specific database to be ready '''
     db = db or DB_NAME
-    password = get_db_password()
-    log.debug('using password %s', password)
+    get_db_password()
 
     timeout_limit = datetime.now() + timedelta(seconds=timeout)
     while datetime.now() <= timeout_limit:
         try:
-            for line in exec_sql_in_db('SHOW DATABASES;'):
-                if db in line:
+            for row in db_query('SHOW DATABASES;'):
+                if db == row[0]:
                     log.debug('Database "%s" seems to be ready', db)
                     return
         except:
@@ -220,7 +748,7 @@ def wait_for_db(db=None, timeout=CONTAINER_START_TIMEOUT):
 
         log.info("Waiting for database {} ({} left)...".format(
             db, timeout_limit - datetime.now()))
-        time.sleep(5)
+        traced_sleep(5, 'wait_for_db')
 
     raise ContainerWaitTimeout(
         'timeout while waiting for database {}'.format(db))
@@ -230,9 +758,53 @@ def wait_for_db(db=None, timeout=CONTAINER_START_TIMEOUT):
 def pillar_db_insert(key, value, **kwargs):
     ''' Insert a value for a pillar (replacing any previous value) '''
     log.info('Adding pillar "%s"="%s"', key, value)
-    cmd = DB_INSERT_PILLAR_CMD.format(**locals())
-    for line in exec_sql_in_db(cmd, **kwargs):
-        yield line
+    db_query(DB_INSERT_PILLAR_CMD, (key, value, key, value), **kwargs)
+
+
+def pillar_db_bulk_insert(pairs, max_size=DB_BULK_MAX_SIZE, **kwargs):
+    '''
+    Insert many pillars (a list of `(key, value)`), replacing any previous value.
+
+    All the pillars are written in as few statements as possible: each
+    chunk (of at most `max_size` bytes) is a single transaction with
+    a multi-row DELETE and a multi-row INSERT. We stop at the first chunk
+    that fails, and nothing in that chunk is applied (but the previous
+    chunks are).
+    '''
+    pairs = list(OrderedDict.fromkeys(pairs))  # remove duplicates
+
+    chunks = []
+    chunk, chunk_size = [], 0
+    for key, value in pairs:
+        row = '({},{})'.format(sql_quote(key), sql_quote(value))
+        # every row is present in both the DELETE and the INSERT
+        row_size = 2 * (len(row) + 1)
+        if chunk and chunk_size + row_size > max_size:
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append(row)
+        chunk_size += row_size
+    if chunk:
+        chunks.append(chunk)
+
+    total_start = time.time()
+    for num, rows in enumerate(chunks, 1):
+        cmd = DB_BULK_INSERT_PILLAR_CMD.format(rows=','.join(rows))
+        start = time.time()
+        try:
+            # (`mysql` stops at the first error, so the COMMIT is not run
+            # and the transaction is rolled back when the client exits)
+            db_query(cmd, **kwargs)
+        except (DBError, subprocess.CalledProcessError):
+            log.error('pillars: chunk %d/%d failed: none of its %d keys were applied '
+                      '(%d keys in previous chunks were)',
+                      num, len(chunks), len(rows), sum(len(c) for c in chunks[:num - 1]))
+            raise
+        log.info('pillars: chunk %d/%d: %d keys applied in %.2f secs',
+                 num, len(chunks), len(rows), time.time() - start)
+
+    log.info('pillars: %d keys applied in %.2f secs',
+             len(pairs), time.time() - total_start)
 
 
 #########################
@@ -240,6 +812,124 @@ def pillar_db_insert(key, value, **kwargs):
 #########################
 
 
+SALT_TRANSPORTS = ['cli', 'api', 'helper']
+
+# the current Salt transport, and the client for it (`None` for the CLI)
+_salt_transport = SALT_TRANSPORT
+_salt_client = None
+
+# connect to the salt-api even if we cannot verify its certificate
+_salt_api_insecure = False
+
+
+def set_salt_transport(transport):
+    ''' Set the transport used for talking to Salt (one of `SALT_TRANSPORTS`) '''
+    global _salt_transport, _salt_client
+    if transport not in SALT_TRANSPORTS:
+        raise CommandError('unknown Salt transport "{}"'.format(transport))
+
+    if _salt_client:
+        _salt_client.close()
+    _salt_transport, _salt_client = transport, None
+
+
+def set_salt_api_insecure(insecure):
+    ''' Allow connecting to the salt-api without verifying its certificate '''
+    global _salt_api_insecure
+    _salt_api_insecure = insecure
+
+
+def get_salt_client():
+    ''' Get a client for the current Salt transport (or `None` when using the CLI) '''
+    global _salt_client
+    if _salt_transport == 'cli':
+        return None
+
+    if _salt_client and _salt_transport == 'helper' and not _salt_client.is_alive():
+        # the helper has died (maybe the container has been restarted)
+        _salt_client.close()
+        _salt_client = None
+
+    if _salt_transport == 'api' and is_remote_docker_host():
+        # the salt-api is at SALT_API_URL (in this machine), not in the
+        # Admin Node at $DOCKER_HOST, and we would send it its password
+        log.warning('the salt-api cannot be used with DOCKER_HOST=%s: using the Salt helper',
+                    os.environ['DOCKER_HOST'])
+        set_salt_transport('helper')
+
+    if not _salt_client:
+        if _salt_transport == 'api':
+            password = None
+            for line in exec_in_container('api', 'cat ' + SALT_API_PASSWORD_FILE, wait=True):
+                password = line.strip()  # only the first line
+                tracer.register_secret(password)
+                break
+            from .saltapi import SaltAPIClient
+            _salt_client = SaltAPIClient(password=password, insecure=_salt_api_insecure)
+        else:
+            wait_for_container('salt-master')
+            from .salthelper import SaltHelperClient
+            client = SaltHelperClient(get_cid('salt-master'))
+            try:
+                client.ping()
+            except (SaltClientError, OSError) as e:
+                log.warning('could not start the Salt helper (%s): using the CLI', e)
+                client.close()
+                set_salt_transport('cli')
+                return None
+            _salt_client = client
+
+    return _salt_client
+
+
+def parse_salt_cmd(cmd):
+    ''' Parse a Salt command (ie, `grains.set roles kube-master`) in `(fun, args, kwargs)` '''
+    tokens = shlex.split(cmd)
+    if not tokens:
+        raise CommandError('no Salt function provided')
+
+    args, kwargs = [], {}
+    for token in tokens[1:]:
+        m = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)=(.*)$', token, re.DOTALL)
+        if m:
+            kwargs[m.group(1)] = salt_arg_to_native(m.group(2))
+        else:
+            args.append(salt_arg_to_native(token))
+
+    return tokens[0], args, kwargs
+
+
+def salt_arg_to_native(arg):
+    ''' Convert an argument to a native value (like Salt does with the CLI arguments) '''
+    if arg in ['True', 'true']:
+        return True
+    elif arg in ['False', 'false']:
+        return False
+    elif arg in ['None', 'null']:
+        return None
+
+    try:
+        return json.loads(arg)
+    except ValueError:
+        return arg
+
+
+def format_salt_return(ret, out=None, newlines=True):
+    ''' Format the (structured) return of a Salt function, like the Salt outputters do '''
+    if out == 'json':
+        text = json.dumps(ret, indent=4)
+    elif not out and newlines and isinstance(ret, dict):
+        values = []
+        for value in ret.values():
+            values.extend(value if isinstance(value, list) else [value])
+        text = '\n'.join(str(v) for v in values)
+    else:
+        text = to_yaml(ret)
+
+    for line in text.splitlines():
+        yield line + '\n'
+
+
 def get_salt_where_from(name):
     if not name:
         return '*'
@@ -266,6 +956,43 @@ def get_salt_where_from(name):
         return name
 
 
+def resolve_salt_target(name):
+    '''
+    Get the target for a name, replacing the matchers on roles
+    (like `G@roles:kube-master`) by the list of minions with those
+    roles in the roles index (ie, `L@id1,id2`), so the master does not
+    need to evaluate the grains of all the minions. The matcher is
+    kept when the list would be too long for a command line.
+    '''
+    tgt = get_salt_where_from(name)
+    m = ROLES_TARGET_RE.match(tgt)
+    if not m:
+        return tgt
+
+    index = get_roles_index()
+    if index is None:
+        return tgt
+
+    if m.group(1) == 'G':
+        minions = index.get(m.group(2), [])
+    else:
+        minions = set()
+        for role, role_minions in index.items():
+            if re.match(m.group(2), role):
+                minions.update(role_minions)
+
+    if not minions:
+        return tgt  # let Salt say there are no minions
+
+    target = 'L@' + ','.join(sorted(minions))
+    if len(target) > ROLES_TARGET_MAX_SIZE:
+        log.debug('too many minions (%d) for a list: using "%s"', len(minions), tgt)
+        return tgt
+
+    return target
+
+
+@traced('salt')
 def exec_in_salt(cmd,
                  compound=None,
                  color=False,
@@ -274,12 +1001,18 @@ def exec_in_salt(cmd,
                  out=None,
                  salt_args='',
                  debug=False,
+                 passthrough=False,
                  **kwargs):
+    '''
+    Run a Salt function, yielding the lines in its output. With `passthrough`
+    (for outputs that are only printed, like some big `pillar.items`), the
+    output is copied as it is to our output, when possible, and nothing is yielded.
+    '''
     debug_level = 'critical' if not debug else 'debug'
     color_arg = '--force-color' if color else '--no-color'
 
     if compound:
-        compound_arg = " -C '{}'".format(get_salt_where_from(compound))
+        compound_arg = " -C '{}'".format(resolve_salt_target(compound))
     else:
         compound_arg = ''
 
@@ -293,28 +1026,187 @@ def exec_in_salt(cmd,
 
     # TODO: add other matchers
 
+    client = get_salt_client()
+    if client:
+        if kwargs.get('wait') and _salt_transport == 'api':
+            wait_for_container('api')
+
+        fun, args, fun_kwargs = parse_salt_cmd(cmd)
+        tgt = resolve_salt_target(compound)
+        if not out and newlines:
+            # values can be printed as soon as they arrive
+            for minion, ret in client.local_iter(tgt, fun, args, fun_kwargs):
+                for line in format_salt_return({minion: ret}, newlines=True):
+                    yield line
+        else:
+            ret = client.local(tgt, fun, args, fun_kwargs)
+            for line in format_salt_return(ret, out=out, newlines=newlines):
+                yield line
+        return
+
     cmd = '/usr/bin/salt {cmd_args} {cmd}'.format(**locals())
     if ignore_stderr:
         cmd = cmd + ' 2>/dev/null'
 
+    out = get_raw_output() if passthrough else None
+    if out is not None:
+        for _ in exec_in_container_raw('salt', cmd, out, **kwargs):
+            pass
+        return
+
     for line in exec_in_container('salt', cmd, **kwargs):
         if line:
             yield line
 
 
-def exec_salt_runner(cmd, **kwargs):
+@traced('salt')
+def exec_in_salt_json(cmd, compound=None, salt_args='', debug=False, **kwargs):
+    '''
+    Run a Salt function, returning a `SaltResult` with the
+    (parsed) return of each minion, instead of some lines of text.
+    '''
+    fun, args, fun_kwargs = parse_salt_cmd(cmd)
+    tgt = resolve_salt_target(compound)
+    result = SaltResult(fun, tgt)
+
+    client = get_salt_client()
+    if client:
+        if kwargs.get('wait') and _salt_transport == 'api':
+            wait_for_container('api')
+
+        for minion, data in client.local_full(tgt, fun, args, fun_kwargs).items():
+            if not isinstance(data, dict) or 'ret' not in data:
+                if isinstance(data, dict) and data.get('failed'):
+                    result.add(minion, None, status=STATUS_MISSING)
+                else:
+                    result.add(minion, data)
+                continue
+            result.add(minion, data['ret'], retcode=data.get('retcode'))
+        return result
+
+    debug_level = 'critical' if not debug else 'debug'
+    compound_arg = " -C '{}'".format(tgt) if compound else ''
+    cmd = '/usr/bin/salt {compound_arg} --log-level={debug_level} {salt_args} ' \
+          '--out=json --out-indent=-1 --static {cmd} 2>/dev/null'.format(**locals())
+
+    parser = JSONStreamParser()
+    try:
+        for line in exec_in_container('salt', cmd, **kwargs):
+            for doc in parser.feed(line):
+                if isinstance(doc, dict):
+                    result.add_all(doc)
+    except subprocess.CalledProcessError as e:
+        # Salt returns an error when some minions fail/do not return:
+        # we can still get the returns of the others
+        result.retcode = e.returncode
+
+    if parser.leftover():
+        raise CommandError('could not parse the Salt output: {}'.format(parser.leftover()))
+
+    return result
+
+
+@traced('salt')
+def exec_salt_runner(cmd, out=None, **kwargs):
     opts = kwargs.pop('salt_args', ORCH_OPTS)
+
+    client = get_salt_client()
+    if client:
+        if kwargs.get('wait') and _salt_transport == 'api':
+            wait_for_container('api')
+
+        fun, args, fun_kwargs = parse_salt_cmd(cmd)
+        ret = client.runner(fun, args, fun_kwargs)
+        for line in format_salt_return(ret, out=out or 'yaml'):
+            yield line
+        return
+
+    if out:
+        opts += ' --out={}'.format(out)
+
     cmd = '/usr/bin/salt-run {} --force-color {}'.format(opts, cmd)
     for line in exec_in_container('salt-master', cmd, **kwargs):
         yield line
 
 
+@traced('salt')
 def exec_salt_key(cmd, **kwargs):
+    client = get_salt_client()
+    if client:
+        if kwargs.get('wait') and _salt_transport == 'api':
+            wait_for_container('api')
+
+        out = _salt_key_with_client(client, cmd)
+        if out is not None:
+            for line in out:
+                yield line
+            return
+
     cmd = '/usr/bin/salt-key --force-color ' + cmd
     for line in exec_in_container('salt-master', cmd, **kwargs):
         yield line
 
 
+# `salt-key -l` statuses, and the sections in `key.list_all` for them
+SALT_KEY_STATUSES = {
+    'acc': ['minions'],
+    'accepted': ['minions'],
+    'pre': ['minions_pre'],
+    'un': ['minions_pre'],
+    'unaccepted': ['minions_pre'],
+    'rej': ['minions_rejected'],
+    'rejected': ['minions_rejected'],
+    'den': ['minions_denied'],
+    'denied': ['minions_denied'],
+    'all': ['minions', 'minions_pre', 'minions_rejected', 'minions_denied'],
+}
+
+SALT_KEY_TITLES = {
+    'minions': 'Accepted Keys:',
+    'minions_pre': 'Unaccepted Keys:',
+    'minions_rejected': 'Rejected Keys:',
+    'minions_denied': 'Denied Keys:',
+}
+
+
+def _salt_key_with_client(client, cmd):
+    '''
+    Emulate (some of) the `salt-key` commands with the wheel client,
+    returning the output lines (or `None` if the command is not supported)
+    '''
+    args = shlex.split(cmd)
+    out_json = '--out=json' in args
+
+    if '-l' in args:
+        status = args[args.index('-l') + 1]
+        if status not in SALT_KEY_STATUSES:
+            return None
+
+        keys = client.wheel('key.list_all')
+        sections = SALT_KEY_STATUSES[status]
+        if out_json:
+            return format_salt_return({s: keys.get(s, []) for s in sections}, out='json')
+
+        lines = []
+        for section in sections:
+            lines.append(SALT_KEY_TITLES[section] + '\n')
+            lines += [k + '\n' for k in keys.get(section, [])]
+        return lines
+
+    if '--accept-all' in args or '-A' in args:
+        match = '*'
+    elif '-a' in args:
+        match = args[args.index('-a') + 1]
+    else:
+        return None
+
+    accepted = client.wheel('key.accept', {'match': match}).get('minions', [])
+    if not accepted:
+        # `salt-key` fails when no keys match
+        raise subprocess.CalledProcessError(1, 'salt-key ' + cmd)
+    return ['Key for minion {} accepted.\n'.format(k) for k in accepted]
+
+
 def get_salt_keys(status='all'):
     for line in exec_salt_key('-l ' + status, wait=True):
         yield line
@@ -335,18 +1227,111 @@ def get_salt_keys_accepted_num():
     return len(out[1:])
 
 
+def get_salt_keys_accepted_ids():
+    ''' Get the IDs of the minions with their keys accepted '''
+    out = ''.join(exec_salt_key('-l acc --out=json', wait=True))
+    return set(json.loads(out).get('minions', []))
+
+
+def watch_salt_events(tag, timeout):
+    '''
+    Watch the Salt events bus, returning an iterator with `(tag, data)` for
+    the events matching `tag` in the next `timeout` seconds.
+
+    The watcher is started immediately, so no events are lost between
+    this call and the first iteration.
+    '''
+    c = get_cid('salt-master')
+    if not c:
+        raise ContainerNotFoundException('could not find container salt-master')
+
+    # the runner is stopped with `timeout`, as killing `docker exec` would not stop it
+    cmd = ['docker', 'exec', c, 'timeout', str(int(timeout)),
+           '/usr/bin/salt-run', 'state.event', tag,
+           'count=-1', 'quiet=False', 'pretty=False']
+    log.debug('salt-events: watching "%s"', tag)
+
+    def parse_event(line):
+        try:
+            event_tag, event_data = line.rstrip('\n').split('\t', 1)
+            return event_tag, json.loads(event_data)
+        except ValueError:
+            log.debug('salt-events: ignoring "%s"', line.strip())
+            return None
+
+    return ProcessOutput(cmd, parser=parse_event)
+
+
+# the IDs of minions we accept from a `salt/auth` event (anyone can submit
+# a key with any ID, and the ID ends in a command line)
+MINION_ID_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
 def wait_for_num_keys_accepted(num_keys, timeout=CONTAINER_START_TIMEOUT):
     log.info("Waiting for %d Salt keys to be accepted...", num_keys)
     wait_for_container('salt')
 
     timeout_limit = datetime.now() + timedelta(seconds=timeout)
+
+    # start watching the `salt/auth` events before accepting the keys
+    # that are already pending, so we do not miss any key in between
+    try:
+        events = watch_salt_events('salt/auth', timeout)
+    except Exception as e:
+        log.debug('could not watch the Salt events: %s', e)
+        events = None
+
+    if events is not None:
+        try:
+            try:
+                for line in exec_salt_key('--accept-all --yes'):
+                    yield line
+            except subprocess.CalledProcessError:
+                pass  # this will fail if no keys have been submitted yet
+
+            accepted = get_salt_keys_accepted_ids()
+            log.info("Waiting for %d Salt keys to be accepted: %d accepted...",
+                     num_keys, len(accepted))
+            if len(accepted) >= num_keys:
+                return
+
+            for event_tag, event in events:
+                minion_id, act = event.get('id'), event.get('act')
+                if not minion_id or minion_id in accepted:
+                    continue
+                if not MINION_ID_RE.match(minion_id):
+                    log.warning('ignoring key with an invalid minion ID: %r', minion_id)
+                    continue
+
+                if act == 'pend':
+                    yield '{} {}: key pending\n'.format(datetime.now().isoformat(), minion_id)
+                    try:
+                        for line in exec_salt_key('-a {} --yes'.format(shlex.quote(minion_id))):
+                            pass
+                    except subprocess.CalledProcessError as e:
+                        log.warning('could not accept key for %s: %s', minion_id, e)
+                        continue
+                elif act != 'accept':
+                    continue
+
+                accepted.add(minion_id)
+                yield '{} {}: key accepted ({}/{})\n'.format(
+                    datetime.now().isoformat(), minion_id, len(accepted), num_keys)
+                if len(accepted) >= num_keys:
+                    return
+        except Exception as e:
+            log.debug('could not watch the Salt events: %s', e)
+        finally:
+            events.close()
+
+    # fallback to polling (for the time left)
     while datetime.now() <= timeout_limit:
         # accept all the pending keys
         # this will fail if no keys have been submitted yet
         try:
             for line in exec_salt_key('--accept-all --yes'):
                 yield line
-        except:
+        except subprocess.CalledProcessError:
             pass
 
         num_accepted = get_salt_keys_accepted_num()
@@ -355,7 +1340,7 @@ def wait_for_num_keys_accepted(num_keys, timeout=CONTAINER_START_TIMEOUT):
 
         log.info("Waiting for %d Salt keys to be accepted: %d accepted (%s secs left)...",
                  num_keys, num_accepted, str(timeout_limit - datetime.now()))
-        time.sleep(5)
+        traced_sleep(5, 'wait_for_num_keys_accepted')
 
     raise ContainerWaitTimeout(
         'timeout waiting for {} to be accepted'.format(num_keys))
@@ -365,50 +1350,300 @@ SALT_AVAIL_SYNC = ['all', 'engines', 'grains', 'beacons', 'utils', 'returners',
                    'modules', 'renderers', 'log_handlers', 'states', 'sdb', 'proxymodules', 'output']
 
 
-def salt_sync(what='all'):
-    what = what.strip().lower()
-    if what not in SALT_AVAIL_SYNC:
-        raise CommandError('unknown sync target "{}"'.format(what))
+# directories with the custom modules for some sync targets (otherwise, `_<target>`)
+SALT_SYNC_DIRS = {
+    'log_handlers': '_log_handlers',
+    'proxymodules': '_proxy',
+    'output': '_output',
+}
 
-    log.info('Synchronizing %s', what)
-    cmd = 'saltutil.sync_{} refresh=True'.format(what)
-    for line in exec_in_salt(cmd, compound='*', wait=True):
-        yield line
+
+def parse_sync_targets(what):
+    ''' Get the list of sync targets in a string (like "grains,modules") or list '''
+    if isinstance(what, str):
+        what = re.split(r'[\s,]+', what.strip())
+
+    targets = [w.strip().lower() for w in what if w.strip()] or ['all']
+    for target in targets:
+        if target not in SALT_AVAIL_SYNC:
+            raise CommandError('unknown sync target "{}"'.format(target))
+
+    return ['all'] if 'all' in targets else targets
+
+
+def get_salt_sync_fingerprints():
+    '''
+    Get a fingerprint of the custom modules in the salt-master for each
+    sync target (including the accepted minions, as new minions need a sync too)
+    '''
+    roots = ' '.join(shlex.quote(r) for r in SALT_FILE_ROOTS)
+    script = 'find {} -path "*/_*/*" -type f 2>/dev/null | sort | xargs -r md5sum'.format(roots)
+    files = {}
+    for line in exec_in_container('salt-master', 'sh -c {}'.format(shlex.quote(script)), wait=True):
+        fields = line.strip().split(None, 1)
+        if len(fields) != 2:
+            continue
+        digest, path = fields
+        for root in SALT_FILE_ROOTS:
+            if path.startswith(root.rstrip('/') + '/'):
+                rel = path[len(root.rstrip('/')) + 1:]
+                files.setdefault(rel.split('/')[0], []).append('{} {}'.format(digest, rel))
+
+    minions = ' '.join(sorted(get_salt_keys_accepted_ids()))
+
+    def fingerprint(dirs):
+        h = hashlib.sha256(minions.encode('utf-8'))
+        for d in sorted(dirs):
+            for f in files.get(d, []):
+                h.update(f.encode('utf-8'))
+        return h.hexdigest()
+
+    fingerprints = {}
+    for target in SALT_AVAIL_SYNC:
+        if target != 'all':
+            fingerprints[target] = fingerprint([SALT_SYNC_DIRS.get(target, '_' + target)])
+    fingerprints['all'] = fingerprint(files.keys())
+    return fingerprints
+
+
+def salt_sync(what='all', force=True):
+    '''
+    Synchronize the custom modules (for some targets, like `['grains', 'modules']`)
+    in all the minions. Unless `force`d, targets that have not changed since the
+    last synchronization are skipped.
+    '''
+    targets = parse_sync_targets(what)
+
+    fingerprints = {}
+    synced = load_state(SALT_SYNC_STATE_FILE, {})
+    if not force:
+        try:
+            fingerprints = get_salt_sync_fingerprints()
+        except Exception as e:
+            log.debug('could not get the fingerprint of the Salt modules: %s', e)
+
+        if fingerprints:
+            unchanged = [t for t in targets if synced.get(t) == fingerprints[t]]
+            for target in unchanged:
+                log.info('Skipping the synchronization of %s: nothing has changed', target)
+            targets = [t for t in targets if t not in unchanged]
+
+    for target in targets:
+        log.info('Synchronizing %s', target)
+        cmd = 'saltutil.sync_{} refresh=True'.format(target)
+        try:
+            result = exec_in_salt_json(cmd, compound='*', wait=True)
+        finally:
+            # custom grains can have changed anywhere
+            _grain_cache.clear()
+            forget_roles_index()
+
+        for minion, status in result.statuses.items():
+            yield '{}: {}\n'.format(minion, result.returns[minion] if status == STATUS_OK else status)
+
+        # do not skip it next time if some minion has not been synchronized
+        # (the clients do not even return the minions that did not answer)
+        unsynced = set(result.missing + result.failed)
+        if not unsynced and not result.retcode:
+            unsynced = get_salt_keys_accepted_ids() - set(result.minions())
+        if unsynced or result.retcode:
+            log.warning('%s not synchronized in %s', target, ', '.join(sorted(unsynced)) or 'some minions')
+            if target == 'all':
+                synced = {}
+            else:
+                synced.pop(target, None)
+                synced.pop('all', None)
+            save_state(SALT_SYNC_STATE_FILE, synced)
+            continue
+
+        if not fingerprints:
+            try:
+                fingerprints = get_salt_sync_fingerprints()
+            except Exception as e:
+                log.debug('could not get the fingerprint of the Salt modules: %s', e)
+                continue
+
+        if target == 'all':
+            synced = dict(fingerprints)
+        else:
+            synced[target] = fingerprints[target]
+            synced.pop('all', None)
+        save_state(SALT_SYNC_STATE_FILE, synced)
+
+
+#########################
+# Grains
+#########################
+
+# grains obtained in this session
+_grain_cache = GrainCache()
+
+# the index of `role -> [minions]`, as `(index, expiration time)`
+_roles_index = None
+_roles_index_ttl = ROLES_INDEX_TTL
+_roles_index_lock = threading.Lock()
+
+# matchers we can resolve with the roles index
+ROLES_TARGET_RE = re.compile(r'^([GP])@roles:(.+)$')
+
+
+def get_grain_cache():
+    return _grain_cache
+
+
+def set_grain_cache_ttl(ttl):
+    ''' Set the TTL for the grains cache (0 for disabling it) '''
+    _grain_cache.ttl = ttl
+    _grain_cache.clear()
 
 
 def grain_set(where, key, value):
     log.info("Setting grain %s=%s in %s", key, value, where)
     cmd = 'grains.set "{}" "{}"'.format(key, value)
-    for line in exec_in_salt(cmd, compound=where, wait=True):
-        yield line
+    try:
+        for line in exec_in_salt(cmd, compound=where, wait=True):
+            yield line
+    finally:
+        _grain_cache.invalidate(key, get_salt_where_from(where))
+        if key.split(':')[0] == 'roles':
+            forget_roles_index()
 
 
 def grain_append(where, key, value):
     log.info("Appending grain %s=%s in %s", key, value, where)
     cmd = 'grains.append "{}" "{}"'.format(key, value)
-    for line in exec_in_salt(cmd, compound=where, wait=True):
-        yield line
+    try:
+        for line in exec_in_salt(cmd, compound=where, wait=True):
+            yield line
+    finally:
+        _grain_cache.invalidate(key, get_salt_where_from(where))
+        if key.split(':')[0] == 'roles':
+            forget_roles_index()
+
+
+def get_roles_index(refresh=False):
+    '''
+    Get the index of `role -> [minions]`, built with one query for the
+    `roles` grain in all the minions (or `None` if it is not available)
+    '''
+    global _roles_index
+    if _roles_index_ttl <= 0:
+        return None
+
+    with _roles_index_lock:
+        if not refresh and _roles_index and _roles_index[1] > time.time():
+            return _roles_index[0]
+
+        try:
+            result = grain_get_by_minion('*', 'roles', cached=not refresh)
+        except Exception as e:
+            log.debug('roles-index: could not get the roles: %s', e)
+            return None
+
+        if result.missing or result.failed:
+            # do not leave minions out
+            log.debug('roles-index: some minions did not return: not using the index')
+            _roles_index = None
+            return None
+
+        index = {}
+        for minion, roles in result.items():
+            if not isinstance(roles, list):
+                roles = [roles] if roles else []
+            for role in roles:
+                index.setdefault(role, []).append(minion)
+
+        log.debug('roles-index: %d roles in %d minions', len(index), len(result))
+        _roles_index = (index, time.time() + _roles_index_ttl)
+        return index
+
+
+def roles_index_cached():
+    return _roles_index is not None and _roles_index[1] > time.time()
+
+
+def forget_roles_index():
+    global _roles_index
+    _roles_index = None
+
+
+def set_roles_index_ttl(ttl):
+    ''' Set the TTL for the roles index (0 for disabling it) '''
+    global _roles_index_ttl
+    _roles_index_ttl = ttl
+    forget_roles_index()
 
 
 def grain_get(where, key):
     log.info("Getting grain %s in %s", key, where)
-    cmd = 'grains.get {}'.format(key)
-    for line in exec_in_salt(cmd, compound=where, wait=True):
+    result = grain_get_by_minion(where, key)
+    for line in format_salt_return(OrderedDict(result.items()), newlines=True):
         yield line
 
 
+def _grain_query(where, grain, cmd, cached):
+    tgt = get_salt_where_from(where)
+    if cached:
+        values = _grain_cache.get(tgt, grain)
+        if values is not None:
+            log.debug('grains: using cached %s in %s', grain, tgt)
+            result = SaltResult(cmd, tgt)
+            for minion in sorted(values.keys()):
+                result.add(minion, values[minion], status=STATUS_OK)
+            return result
+
+    result = exec_in_salt_json(cmd, compound=where, wait=True)
+    if len(result) > 0 and not result.missing and not result.failed:
+        _grain_cache.put(tgt, grain, OrderedDict(result.items()))
+    return result
+
+
+def grain_get_by_minion(where, key, cached=True):
+    ''' Get a grain in some minions, returning a `SaltResult` (`{minion: value}`) '''
+    log.debug("Getting grain %s in %s", key, where)
+    return _grain_query(where, key, 'grains.get {}'.format(key), cached)
+
+
+def grain_items_by_minion(where, cached=True):
+    ''' Get all the grains in some minions, returning a `SaltResult` (`{minion: grains}`) '''
+    return _grain_query(where, ALL_GRAINS, 'grains.items', cached)
+
+
+def _cached_grain_items(where):
+    ''' All the grains in some minions, only if they are in the cache (or `None`) '''
+    return _grain_cache.get(get_salt_where_from(where), ALL_GRAINS)
+
+
 def grain_ls(where):
     log.info("Listing grains (in '%s')", where)
-    cmd = 'grains.ls'
-    for line in exec_in_salt(cmd, compound=where, wait=True):
+    values = _cached_grain_items(where)
+    if values is None:
+        # (`grains.ls` is much smaller than getting all the grains)
+        for line in exec_in_salt('grains.ls', compound=where, wait=True):
+            yield line
+        return
+
+    names = OrderedDict((minion, sorted(values[minion].keys())) for minion in sorted(values.keys()))
+    for line in format_salt_return(names, newlines=True):
         yield line
 
 
 def grain_items(where):
     log.info("Listing grains (in '%s')", where)
-    cmd = 'grains.items'
-    for line in exec_in_salt(cmd, compound=where, wait=True, out='yaml'):
-        yield line
+    values = _cached_grain_items(where)
+    if values is not None:
+        try:
+            import yaml
+        except ImportError:
+            values = None  # (keep the output of Salt, in YAML)
+
+    if values is None:
+        for line in exec_in_salt('grains.items', compound=where, wait=True, out='yaml'):
+            yield line
+        return
+
+    # (a single chunk, as this can be big and it is only printed)
+    yield yaml.safe_dump(dict(values), default_flow_style=False)
 
 
 #########################
@@ -418,19 +1653,25 @@ def grain_items(where):
 
 def get_role_nodenames(role, timeout=CONTAINER_START_TIMEOUT):
     ''' Get the nodename for all the nodes with a specific role '''
-    log.debug("get-role-nodenames: getting nodenames for {}...".format(role))
+    log.debug("get-role-nodenames: getting nodenames for %s...", role)
     timeout_limit = datetime.now() + timedelta(seconds=timeout)
     while datetime.now() <= timeout_limit:
         try:
-            for line in grain_get(role, 'nodename'):
-                yield line
+            result = grain_get_by_minion(role, 'nodename')
+            if len(result) > 0 and not result.missing:
+                for nodename in result.values():
+                    yield '{}\n'.format(nodename)
+                return
+
+            if result.missing:
+                log.debug('get-role-nodenames: no response from %s', ', '.join(result.missing))
         except Exception as e:
             log.warning(
                 'get-role-nodenames: while waiting for nodename for %s: %s', role, e)
 
         log.debug("get-role-nodenames: waiting for result for {} ({} left)...".format(
             role, timeout_limit - datetime.now()))
-        time.sleep(5)
+        traced_sleep(5, 'get_role_nodenames')
 
     raise Exception('could not get nodename for {}'.format(role))
 
@@ -469,10 +1710,35 @@ def value_to_native(val):
     return val
 
 
-def expandvars(path):
+def shell_dquote(txt):
+    ''' Escape some text for using it in a double-quoted shell string '''
+    return re.sub(r'([\\"$`])', r'\\\1', txt)
+
+
+# a `$NAME` or `${NAME}` (not escaped)
+VARIABLE_RE = re.compile(r'(?<!\\)\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+def expandvars(path, variables=None):
+    ''' Replace the `variables` (a dict) and the environment variables (removing the undefined ones) '''
+    if variables:
+        def replacer(m):
+            name = m.group(1) or m.group(2)
+            return str(variables[name]) if name in variables else m.group(0)
+
+        path = VARIABLE_RE.sub(replacer, path)
     return re.sub(r'(?<!\\)\$[A-Za-z_][A-Za-z0-9_]*', '', os.path.expandvars(path))
 
 
+def to_yaml(obj):
+    ''' Dump some object as YAML (or as JSON, if no YAML module is available) '''
+    try:
+        import yaml
+        return yaml.safe_dump(obj, default_flow_style=False)
+    except ImportError:
+        return json.dumps(obj, indent=4)
+
+
 def on_color(color, txt):
     res = ''
     if isinstance(color, list):
@@ -487,6 +1753,29 @@ def prompt(txt):
     return on_color(PROMPT_COLORS, '{} >'.format(txt)) + ' '
 
 
+def format_table(rows):
+    ''' Format a list of rows (dicts) as a table, like the `mysql` client does '''
+    if not rows:
+        return
+
+    columns = list(rows[0].keys())
+    values = [['NULL' if row[c] is None else str(row[c]) for c in columns]
+              for row in rows]
+    widths = [max([len(c)] + [len(v[i]) for v in values])
+              for i, c in enumerate(columns)]
+
+    def format_row(fields):
+        return '| ' + ' | '.join(f.ljust(w) for f, w in zip(fields, widths)) + ' |\n'
+
+    separator = '+' + '+'.join('-' * (w + 2) for w in widths) + '+\n'
+    yield separator
+    yield format_row(columns)
+    yield separator
+    for v in values:
+        yield format_row(v)
+    yield separator
+
+
 def print_iterator(it, **kwargs):
     for line in it:
         sys.stdout.write(line)
@@ -48,7 +48,7 @@ class CaaSPConfig(CmdBase):
 
         key, value = line_comps[0].strip(), line_comps[1].strip()
         log.info('Setting the %s to %s', key, value)
-        print_iterator(pillar_db_insert(key, value, wait=True))
+        pillar_db_insert(key, value, wait=True)
 
     def do_load(self, line):
         '''
@@ -67,7 +67,7 @@ class CaaSPConfig(CmdBase):
         '''
         filename = line
         log.info('Loading config variables from %s', filename)
-        wait_for_db()
+        pairs = []
         with open(filename, 'r') as f:
             for line in f.readlines():
                 line = line.strip()
@@ -81,7 +81,14 @@ class CaaSPConfig(CmdBase):
                     continue
 
                 key, value = line_comps[0].strip(), line_comps[1].strip()
-                print_iterator(pillar_db_insert(key, value))
+                pairs.append((key, value))
+
+        if not pairs:
+            log.warning('no config variables found in %s', filename)
+            return
+
+        wait_for_db()
+        pillar_db_bulk_insert(pairs)
 
     def do_get(self, line):
         '''
@@ -109,7 +116,8 @@ class CaaSPConfig(CmdBase):
 
         log.info('Getting %s at %s', key, where)
         out_it = exec_in_salt(cmd, compound=where,
-                              color=True, out='yaml', wait=True)
+                              color=True, out='yaml', wait=True,
+                              passthrough=True)
         print_iterator(out_it)
 
     # TODO: this should probably be removed...
@@ -122,7 +130,8 @@ class CaaSPConfig(CmdBase):
         > pillar db
         '''
         log.info('Getting pillar database')
-        print_iterator(exec_sql_in_db(DB_QUERY_PILLAR_CMD, wait=True))
+        print_iterator(format_table(
+            db_query(DB_QUERY_PILLAR_CMD, as_dict=True, wait=True)))
 
     # TODO: this should probably be removed...
     def do_flush(self, line):
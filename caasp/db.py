@@ -0,0 +1,247 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import itertools
+import logging
+import re
+import subprocess
+import threading
+
+from .defaults import *
+from .errors import DBError
+
+log = logging.getLogger(__name__)
+
+# column used for marking the end of the output of a statement
+EOT_COLUMN = 'caaspctl_eot'
+
+ERROR_RE = re.compile(r'^ERROR (\d+)( \(\w+\))?')
+
+# mysql error for "access denied" (ie, wrong password)
+ERROR_ACCESS_DENIED = 1045
+
+BATCH_UNESCAPES = {'n': '\n', 't': '\t', '0': '\0', '\\': '\\'}
+
+
+def sql_quote(value):
+    ''' Quote a value for using it in a SQL statement '''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return str(value)
+
+    value = str(value).replace('\\', '\\\\').replace('\'', '\\\'')
+    return "'{}'".format(value)
+
+
+def format_sql(sql, params=None):
+    ''' Replace the `%s` placeholders in some SQL by the (quoted) `params` '''
+    if params is None:
+        return sql
+    return sql % tuple(sql_quote(p) for p in params)
+
+
+def split_sql(sql):
+    ''' Split some SQL in statements (ignoring the `;` in quoted strings) '''
+    statements = []
+    current, quote, escaped = '', None, False
+    for c in sql:
+        if escaped:
+            escaped = False
+        elif c == '\\' and quote:
+            escaped = True
+        elif quote:
+            if c == quote:
+                quote = None
+        elif c in ['\'', '"', '`']:
+            quote = c
+        elif c == ';':
+            if current.strip():
+                statements.append(current.strip())
+            current = ''
+            continue
+        current += c
+
+    if current.strip():
+        statements.append(current.strip())
+    return statements
+
+
+def unescape_batch_value(value):
+    ''' Convert a value in the `mysql --batch` output to a native value '''
+    if value == 'NULL':
+        return None
+    if '\\' not in value:
+        return value
+    return re.sub(r'\\(.)', lambda m: BATCH_UNESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def parse_batch_output(lines, as_dict=False):
+    '''
+    Parse the output of `mysql --batch --column-names`, returning a list
+    of rows (tuples, or dicts when `as_dict`)
+    '''
+    rows = []
+    columns = None
+    for line in lines:
+        line = line.rstrip('\n')
+        if columns is None:
+            columns = line.split('\t')
+            continue
+
+        row = tuple(unescape_batch_value(v) for v in line.split('\t'))
+        rows.append(dict(zip(columns, row)) if as_dict else row)
+    return rows
+
+
+class DBSession(object):
+    '''
+    A long-lived `mysql` client running in the database container,
+    receiving statements in its standard input.
+    '''
+
+    _tokens = itertools.count()
+
+    def __init__(self, cid, password, db=DB_NAME, docker='docker'):
+        self.cid = cid
+        self.password = password
+        self.db = db
+        self.docker = docker
+        self._proc = None
+
+    def start(self):
+        mysql_cmd = 'exec mysql -uroot -p\'{}\' --batch --column-names --unbuffered {} 2>&1'.format(
+            self.password.replace('\'', '\'\\\'\''), self.db)
+        log.debug('db: starting a database session in %s', self.cid)
+        self._proc = subprocess.Popen([self.docker, 'exec', '-i', self.cid, 'sh', '-c', mysql_cmd],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      universal_newlines=True)
+
+    def is_alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def close(self):
+        if self._proc:
+            log.debug('db: closing database session in %s', self.cid)
+            try:
+                self._proc.stdin.close()
+                self._proc.wait(timeout=5)
+            except Exception:
+                self._proc.kill()
+            self._proc = None
+
+    def execute(self, sql, params=None, as_dict=False):
+        '''
+        Run some SQL (maybe with many statements), returning the rows
+        obtained in the last statement.
+        '''
+        if not self.is_alive():
+            self.start()
+
+        statements = split_sql(format_sql(sql, params))
+        tokens = []
+        script = ''
+        for statement in statements:
+            token = 'eot-{}'.format(next(self._tokens))
+            tokens.append(token)
+            script += '{};\nSELECT \'{}\' AS {};\n'.format(statement, token, EOT_COLUMN)
+
+        try:
+            self._proc.stdin.write(script)
+            self._proc.stdin.flush()
+        except (IOError, OSError) as e:
+            self.close()
+            raise DBError('database session is gone: {}'.format(e))
+
+        rows = []
+        for statement, token in zip(statements, tokens):
+            rows = self._read_result(statement, token, as_dict)
+        return rows
+
+    def _read_result(self, statement, token, as_dict):
+        lines = []
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                # (`mysql` exits at the first error, so nothing
+                # after a failed statement is run)
+                output = ''.join(lines).strip()
+                self.close()
+                if lines and ERROR_RE.match(lines[0]):
+                    raise DBError('"{}" failed: {}'.format(statement, output),
+                                  code=self._error_code(output))
+                raise DBError('database session is gone: {}'.format(output),
+                              code=self._error_code(output))
+
+            if line.rstrip('\n') == EOT_COLUMN:
+                end = self._proc.stdout.readline()
+                if end.rstrip('\n') == token:
+                    break
+            lines.append(line)
+
+        if lines and ERROR_RE.match(lines[0]):
+            output = ''.join(lines).strip()
+            raise DBError('"{}" failed: {}'.format(statement, output),
+                          code=self._error_code(output))
+
+        return parse_batch_output(lines, as_dict=as_dict)
+
+    def _error_code(self, output):
+        m = ERROR_RE.search(output)
+        return int(m.group(1)) if m else None
+
+
+class DBPool(object):
+    '''
+    A pool of database sessions.
+    '''
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self, cid, password):
+        with self._lock:
+            while self._idle:
+                session = self._idle.pop()
+                if session.is_alive() and session.cid == cid and session.password == password:
+                    return session
+                session.close()
+
+        return DBSession(cid, password)
+
+    def release(self, session):
+        with self._lock:
+            if session.is_alive() and len(self._idle) < self.size:
+                self._idle.append(session)
+                return
+
+        session.close()
+
+    def close(self):
+        with self._lock:
+            for session in self._idle:
+                session.close()
+            self._idle = []
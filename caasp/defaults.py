@@ -30,6 +30,27 @@ VERSION = "0.1"
 ORCH_BOOTSTRAP = 'kubernetes'
 ORCH_UPDATE = 'update'
 ORCH_OPTS = "-l debug --force-color --hard-crash"
+# max width of the list of minions in the orchestration report
+ORCH_REPORT_MINIONS_WIDTH = 40
+
+# how we talk to Salt: running the CLI tools in the salt-master container ("cli"),
+# with the salt-api REST interface ("api") or with a long-lived helper process
+# running in the salt-master container ("helper")
+SALT_TRANSPORT = 'cli'
+
+# roots (in the salt-master container) of the custom modules (`_modules`, `_grains`...)
+# synchronized to the minions
+SALT_FILE_ROOTS = ['/usr/share/salt/kubernetes/salt', '/srv/salt']
+
+# where we keep the fingerprint of the last modules synchronized (in the state dir)
+SALT_SYNC_STATE_FILE = 'salt-sync.json'
+
+# salt-api access (the password is read from the salt-api container)
+SALT_API_URL = 'https://localhost:8000'
+SALT_API_USER = 'saltapi'
+SALT_API_EAUTH = 'pam'
+SALT_API_PASSWORD_FILE = '/var/lib/misc/infra-secrets/saltapi-password'
+SALT_API_CA_FILE = '/etc/pki/trust/anchors/SUSE_CaaSP_CA.crt'
 
 # some key container (partial) names
 CONTAINER_SALT_MASTER = "salt-master"
@@ -40,6 +61,17 @@ CONTAINER_OPENLDAP = "openldap"
 
 CONTAINER_START_TIMEOUT = 300
 
+# the Docker Engine API socket (we fallback to the `docker` CLI when not available)
+DOCKER_SOCKET = '/var/run/docker.sock'
+DOCKER_API_VERSION = 'v1.24'
+
+# how long (and how often) we check an exec has finished after its output ends
+DOCKER_EXEC_EXIT_TIMEOUT = 10
+DOCKER_EXEC_EXIT_INTERVAL = 0.05
+
+# seconds we trust a cached container ID before looking it up again
+CONTAINER_CACHE_TTL = 600
+
 # where admin certificates will be generated to
 CERT_ADMIN_DIR = "/root/certs"
 
@@ -51,19 +83,78 @@ DB_NAME = "velum_production"
 # password file in the database container
 DB_PASSWORD_FILE = '/var/lib/misc/infra-secrets/mariadb-root-password'
 
+# max number of idle database sessions we keep around
+DB_POOL_SIZE = 2
+
 # command for inserting in the database, querying, etc...
 # - pillar
 DB_INSERT_PILLAR_CMD = \
-    'DELETE FROM pillars WHERE pillar=\'{key}\' AND value=\'{value}\'; ' + \
-    'INSERT INTO pillars (pillar, value) VALUES (\'{key}\', \'{value}\');'
+    'DELETE FROM pillars WHERE pillar=%s AND value=%s; ' + \
+    'INSERT INTO pillars (pillar, value) VALUES (%s, %s);'
+DB_BULK_INSERT_PILLAR_CMD = \
+    'START TRANSACTION; ' + \
+    'DELETE FROM pillars WHERE (pillar, value) IN ({rows}); ' + \
+    'INSERT INTO pillars (pillar, value) VALUES {rows}; ' + \
+    'COMMIT;'
 DB_QUERY_PILLAR_CMD = 'SELECT * FROM pillars;'
 DB_FLUSH_PILLAR_CMD = 'TRUNCATE TABLE pillars;'
+# max size for the multi-row statements (when running a mysql client per statement
+# they are passed as a single argument, and Linux limits arguments to 128KB)
+DB_BULK_MAX_SIZE = 64 * 1024
 # - minions
 DB_QUERY_MINIONS_CMD = 'SELECT * FROM minions;'
 # - events
 DB_QUERY_EVENTS_CMD = 'SELECT data FROM salt_events ORDER BY alter_time;'
 DB_FLUSH_EVENTS_CMD = 'TRUNCATE TABLE salt_events;'
 
+# seconds we keep the grains obtained from the minions (0 for disabling the cache)
+GRAIN_CACHE_TTL = 300
+
+# seconds we keep the index of roles -> minions, used for
+# replacing the roles matchers by lists of minions (0 for disabling it)
+ROLES_INDEX_TTL = 300
+# max size of the list of minions we use instead of a roles matcher (the target
+# can end in a single argument for `sh -c`, and Linux limits arguments to 128KB)
+ROLES_TARGET_MAX_SIZE = 64 * 1024
+
+# number of slowest calls printed with `--profile`
+PROFILE_TOP_N = 20
+
+# max number of commands running at the same time in a parallel block
+PARALLEL_MAX_WORKERS = 8
+
+# directories where we can keep things between runs (the first one writable is used)
+CAASPCTL_STATE_DIRS = [
+    '/var/lib/caaspctl',
+    '~/.caaspctl.d'
+]
+
+# environment variable for using some other state directory
+CAASPCTL_STATE_DIR_ENV = 'CAASPCTL_STATE_DIR'
+
+# max number of compiled scripts kept in the state directory
+SCRIPT_CACHE_MAX = 32
+
+# the socket used by `--serve` and `--client` (in the state directory,
+# unless a path is provided with `--socket` or in the environment)
+SERVER_SOCKET_FILE = 'caaspctl.sock'
+SERVER_SOCKET_ENV = 'CAASPCTL_SOCKET'
+# the environment variables of the daemon that are kept when running the
+# commands of a client (with the environment of the client)
+SERVER_KEEP_ENV = ['DOCKER_HOST', CAASPCTL_STATE_DIR_ENV]
+
+# size of the chunks when copying the output of a command as it is
+RAW_CHUNK_SIZE = 1024 * 1024
+
+# max number of clusters where we run the commands at the same time (with `--cluster`)
+FANOUT_MAX_CLUSTERS = 8
+
+# the directory (in the state directory) with the state directories of those clusters
+FANOUT_STATE_DIR = 'clusters'
+
+# environment variable with the name of the cluster, in the `caaspctl` run in every cluster
+FANOUT_CLUSTER_ENV = 'CAASPCTL_CLUSTER'
+
 # RC files that are automatically loaded on startup
 # can be used for doing some actions or setting default values
 CAASPCTL_RC_FILES = [
@@ -0,0 +1,289 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import http.client
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from urllib.parse import quote, urlencode
+
+from .defaults import *
+from .errors import DockerEngineError
+
+log = logging.getLogger(__name__)
+
+# streams in a multiplexed exec output
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''
+    A HTTP connection over a unix socket
+    '''
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EventStream(object):
+    '''
+    The events in a (connected) events stream, that can
+    be stopped (with `close()`) at any time.
+    '''
+
+    def __init__(self, conn, resp, parser=None):
+        self.conn = conn
+        self.resp = resp
+        self.parser = parser
+
+    def __iter__(self):
+        try:
+            while True:
+                line = self.resp.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+
+                event = json.loads(line.decode('utf-8'))
+                if self.parser:
+                    event = self.parser(event)
+                    if event is None:
+                        continue
+                yield event
+        except (http.client.HTTPException, socket.error) as e:
+            raise DockerEngineError('could not get events: {}'.format(e))
+
+    def close(self):
+        self.conn.close()
+
+
+class DockerEngine(object):
+    '''
+    A (minimal) client for the Docker Engine API, keeping a
+    persistent connection to the local socket.
+    '''
+
+    def __init__(self, path=DOCKER_SOCKET):
+        self.path = path
+        self._local = threading.local()
+
+    def is_available(self):
+        ''' Check if the Docker Engine is listening in the socket '''
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            resp = self._request('GET', '/_ping')
+            resp.read()
+            return resp.status == 200
+        except Exception as e:
+            log.debug('docker-api: engine not available at %s: %s', self.path, e)
+            return False
+
+    @property
+    def _conn(self):
+        # connections are not thread-safe: keep one per thread
+        return getattr(self._local, 'conn', None)
+
+    @_conn.setter
+    def _conn(self, conn):
+        self._local.conn = conn
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, method, path, params=None, body=None):
+        url = '/{}{}'.format(DOCKER_API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        # the engine can close our connection at any time (ie, after
+        # a raw stream), so try again with a fresh connection once
+        for attempt in [1, 2]:
+            if not self._conn:
+                self._conn = UnixHTTPConnection(self.path)
+            try:
+                self._conn.request(method, url, body=body, headers=headers)
+                return self._conn.getresponse()
+            except (http.client.HTTPException, socket.error) as e:
+                self.close()
+                if attempt == 2:
+                    raise DockerEngineError(
+                        'could not talk to the Docker Engine: {}'.format(e))
+
+    def _json(self, method, path, params=None, body=None, expected=(200,)):
+        resp = self._request(method, path, params=params, body=body)
+        data = resp.read()
+        if resp.status not in expected:
+            raise DockerEngineError('{} {}: {} {}'.format(
+                method, path, resp.status, data.decode('utf-8', 'replace').strip()),
+                status=resp.status)
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def containers(self, name=None, label=None):
+        ''' List the running containers, optionally filtered by name/label '''
+        filters = {}
+        if name:
+            filters['name'] = [name]
+        if label:
+            filters['label'] = [label]
+
+        params = {'filters': json.dumps(filters)} if filters else None
+        return self._json('GET', '/containers/json', params=params)
+
+    def find_container(self, name):
+        ''' Get the ID of the first running container with `name` in its name '''
+        for container in self.containers(name=name):
+            for cname in container.get('Names', []):
+                if name in cname:
+                    return container['Id'][:12]
+        return None
+
+    def events(self, filters=None, until=None, parser=None):
+        '''
+        Get the stream of events in the engine (until the `until` timestamp).
+
+        The request is sent here, so no event after this call is missed.
+        This uses a new connection, as the stream blocks it.
+        '''
+        params = {}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        if until:
+            params['until'] = str(int(until))
+
+        conn = UnixHTTPConnection(self.path)
+        try:
+            conn.request('GET', '/{}/events?{}'.format(DOCKER_API_VERSION, urlencode(params)))
+            resp = conn.getresponse()
+        except (http.client.HTTPException, socket.error) as e:
+            conn.close()
+            raise DockerEngineError('could not get events: {}'.format(e))
+
+        if resp.status != 200:
+            conn.close()
+            raise DockerEngineError('could not get events: {}'.format(resp.status),
+                                    status=resp.status)
+
+        return EventStream(conn, resp, parser=parser)
+
+    def exec_in_container(self, cid, cmd, stderr_cb=None, raw=False):
+        '''
+        Run a (shell) command in a container, yielding the lines
+        in the standard output (or the chunks of bytes, as they
+        arrive, with `raw`). The standard error is passed to `stderr_cb`.
+        '''
+        created = self._json('POST', '/containers/{}/exec'.format(quote(cid)),
+                             body={'AttachStdout': True,
+                                   'AttachStderr': True,
+                                   'Tty': False,
+                                   'Cmd': ['/bin/sh', '-c', cmd]},
+                             expected=(201,))
+        exec_id = created['Id']
+
+        resp = self._request('POST', '/exec/{}/start'.format(exec_id),
+                             body={'Detach': False, 'Tty': False})
+        if resp.status != 200:
+            raise DockerEngineError('could not start exec in {}: {} {}'.format(
+                cid, resp.status, resp.read().decode('utf-8', 'replace').strip()),
+                status=resp.status)
+
+        pending = ''
+        for stream, data in self._read_frames(resp):
+            if stream == STREAM_STDERR:
+                if stderr_cb:
+                    stderr_cb(data.decode('utf-8', 'replace'))
+                continue
+
+            if raw:
+                yield data
+                continue
+
+            data = data.decode('utf-8', 'replace')
+            pending += data
+            while '\n' in pending:
+                line, pending = pending.split('\n', 1)
+                yield line + '\n'
+
+        if pending:
+            yield pending
+
+        exit_code = self._exec_exit_code(exec_id)
+        if exit_code is None:
+            raise DockerEngineError('could not get the exit status of command "{}"'.format(cmd))
+        if exit_code:
+            raise DockerEngineError(
+                'command "{}" returned non-zero exit status {}'.format(cmd, exit_code),
+                exit_code=exit_code)
+
+    def _exec_exit_code(self, exec_id):
+        ''' The exit code of an exec, once it is not running (or `None` if we cannot get it) '''
+        # (the exec can still be running for a moment after the stream ends)
+        deadline = time.time() + DOCKER_EXEC_EXIT_TIMEOUT
+        while True:
+            inspect = self._json('GET', '/exec/{}/json'.format(exec_id))
+            if not inspect.get('Running') or time.time() > deadline:
+                break
+            time.sleep(DOCKER_EXEC_EXIT_INTERVAL)
+
+        if inspect.get('Running'):
+            return None
+        return inspect.get('ExitCode')
+
+    def _read_frames(self, resp):
+        ''' Demultiplex the raw stream returned by an exec '''
+        while True:
+            header = resp.read(8)
+            if len(header) < 8:
+                break
+
+            stream, size = struct.unpack('>BxxxL', header)
+            data = b''
+            while len(data) < size:
+                chunk = resp.read(size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+
+            yield stream, data
+
+        resp.close()
@@ -33,3 +33,22 @@ class ContainerNotFoundException(Exception):
 
 class ContainerWaitTimeout(Exception):
     pass
+
+
+class DockerEngineError(Exception):
+
+    def __init__(self, msg, status=None, exit_code=None):
+        Exception.__init__(self, msg)
+        self.status = status
+        self.exit_code = exit_code
+
+
+class DBError(Exception):
+
+    def __init__(self, msg, code=None):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+class SaltClientError(Exception):
+    pass
@@ -0,0 +1,223 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+'''
+Run the same commands (or scripts) in many clusters at the same time.
+
+Every cluster gets its own `caaspctl` process, with `--docker-host` pointing
+to its Admin Node, so the caches (containers, passwords, grains...) and the
+state directory are never shared between clusters.
+'''
+
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from .aexec import run_process
+from .common import format_table, get_async_engine, print_iterator
+from .defaults import *
+from .errors import CommandError
+from .state import get_state_dir
+
+log = logging.getLogger(__name__)
+
+# characters we do not want in the name of a state directory
+UNSAFE_NAME_RE = re.compile(r'[^\w.-]')
+
+
+class Cluster(object):
+    '''
+    A cluster where we run the commands, and how it went
+    '''
+
+    def __init__(self, name, host):
+        self.name = name
+        self.host = host
+        self.returncode = None
+        self.timed_out = False
+        self.start = None
+        self.end = None
+
+    @classmethod
+    def parse(cls, spec):
+        ''' Parse a `[NAME=]HOST` '''
+        name, sep, host = spec.strip().partition('=')
+        if not sep:
+            name, host = '', name
+        if not host:
+            raise CommandError('no host in cluster "{}"'.format(spec))
+        if not name:
+            # (ie, "admin1" for "ssh://root@admin1")
+            name = urlparse(host).hostname or host
+        return cls(name, host)
+
+    @property
+    def done(self):
+        return self.end is not None
+
+    @property
+    def status(self):
+        if self.timed_out:
+            return 'timeout'
+        if self.start is None:
+            return 'not-run'
+        if self.end is None:
+            return 'running'
+        return 'ok' if self.returncode == 0 else 'failed'
+
+    def elapsed(self):
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return OrderedDict([('cluster', self.name),
+                            ('host', self.host),
+                            ('status', self.status),
+                            ('exit', self.returncode),
+                            ('secs', '{:.1f}'.format(self.elapsed()))])
+
+
+def load_clusters(specs, filename=None):
+    '''
+    Get the clusters from a list of `[NAME=]HOST` and/or from
+    a file (with one of them per line, and `#` comments)
+    '''
+    specs = list(specs or [])
+    if filename:
+        with open(filename) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    specs.append(line)
+
+    clusters = OrderedDict()
+    for spec in specs:
+        cluster = Cluster.parse(spec)
+        if cluster.name in clusters:
+            raise CommandError('cluster "{}" specified more than once'.format(cluster.name))
+        clusters[cluster.name] = cluster
+
+    return list(clusters.values())
+
+
+def _safe_name(name):
+    return UNSAFE_NAME_RE.sub('_', name)
+
+
+def cluster_filename(filename, name):
+    ''' The file (ie, a `--trace`) for a cluster: `trace.json` -> `trace.NAME.json` '''
+    if not filename:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, _safe_name(name), ext)
+
+
+def _cluster_env(cluster):
+    env = dict(os.environ)
+    env[FANOUT_CLUSTER_ENV] = cluster.name
+
+    # make sure the child can import us (even when running from a zip)
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([top] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    # the output is shown as it comes
+    env['PYTHONUNBUFFERED'] = '1'
+
+    # keep the things saved between runs (ie, compiled scripts or
+    # orchestration journals) apart for every cluster
+    d = get_state_dir()
+    if d:
+        env[CAASPCTL_STATE_DIR_ENV] = os.path.join(d, FANOUT_STATE_DIR, _safe_name(cluster.name))
+    return env
+
+
+def _prefixed_writer(stream, prefix):
+    def write(line):
+        if not line.endswith('\n'):
+            line += '\n'
+        stream.write(prefix + line)
+        stream.flush()
+    return write
+
+
+async def _run_clusters(clusters, argv, max_running, timeout):
+    sem = asyncio.Semaphore(max_running or len(clusters) or 1)
+
+    async def run_one(cluster):
+        # (the child does not fan out again, as it gets a $CAASPCTL_CLUSTER)
+        cmd = [sys.executable, '-m', __package__,
+               '--docker-host', cluster.host, '--exit-on-error'] + list(argv)
+        prefix = '[{}] '.format(cluster.name)
+
+        async with sem:
+            log.debug('fanout: running in %s: %s', cluster.name, cmd)
+            cluster.start = time.time()
+            try:
+                cluster.returncode = await run_process(cmd,
+                                                       _prefixed_writer(sys.stdout, prefix),
+                                                       _prefixed_writer(sys.stderr, prefix),
+                                                       timeout=timeout,
+                                                       stdin=subprocess.DEVNULL,
+                                                       env=_cluster_env(cluster))
+            except subprocess.TimeoutExpired:
+                log.error('%s: timeout after %s secs', cluster.name, timeout)
+                cluster.timed_out = True
+            finally:
+                cluster.end = time.time()
+
+    await asyncio.gather(*[run_one(cluster) for cluster in clusters])
+
+
+def run_fanout(clusters, argv, max_running=FANOUT_MAX_CLUSTERS, timeout=None):
+    '''
+    Run `caaspctl` (with the arguments in `argv`) in all the clusters,
+    `max_running` at most at the same time, with the output of every
+    cluster prefixed by its name. Returns the exit status: 0 only
+    when all the clusters succeeded.
+    '''
+    log.info('running in %d clusters (%d at most at the same time)',
+             len(clusters), max_running or len(clusters))
+
+    future = get_async_engine().submit(_run_clusters(clusters, argv, max_running, timeout))
+    try:
+        future.result()
+    except KeyboardInterrupt:
+        # (the processes are killed when the coroutine is cancelled)
+        future.cancel()
+        deadline = time.time() + 5
+        while not all(c.done for c in clusters if c.start) and time.time() < deadline:
+            time.sleep(0.1)
+        raise
+    finally:
+        print_iterator(format_table([c.to_dict() for c in clusters]))
+
+    failed = [c.name for c in clusters if c.status != 'ok']
+    if failed:
+        log.error('failed in %d clusters: %s', len(failed), ', '.join(failed))
+        return 1
+    return 0
@@ -0,0 +1,147 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import logging
+import threading
+import time
+
+from .defaults import *
+
+log = logging.getLogger(__name__)
+
+# the key used for storing all the grains in a minion (ie, `grains.items`)
+ALL_GRAINS = '*'
+
+
+class GrainCache(object):
+    '''
+    A cache of grains, as `(minion, grain) -> value`, with the list
+    of minions matched by the targets we have used.
+    '''
+
+    def __init__(self, ttl=GRAIN_CACHE_TTL):
+        self.ttl = ttl
+        self._grains = {}
+        self._targets = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _get(self, table, key):
+        entry = table.get(key)
+        if entry is None:
+            return None
+        value, expiration = entry
+        if expiration < time.time():
+            del table[key]
+            return None
+        return entry
+
+    def get_minions(self, tgt):
+        ''' The minions matched by a target (or `None` if we do not know them) '''
+        with self._lock:
+            entry = self._get(self._targets, tgt)
+            return list(entry[0]) if entry else None
+
+    def get(self, tgt, grain):
+        '''
+        Get a grain in all the minions matched by a target, as a
+        `{minion: value}`, or `None` if something is not in the cache
+        '''
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            minions = self._get(self._targets, tgt)
+            if minions is not None:
+                values = {}
+                for minion in minions[0]:
+                    entry = self._get(self._grains, (minion, grain))
+                    if entry is not None:
+                        values[minion] = entry[0]
+                        continue
+
+                    # maybe we got all the grains in this minion
+                    entry = self._get(self._grains, (minion, ALL_GRAINS))
+                    if entry is None or ':' in grain:
+                        break
+                    values[minion] = entry[0].get(grain)
+                else:
+                    self.hits += 1
+                    return values
+
+            self.misses += 1
+            return None
+
+    def put(self, tgt, grain, values):
+        ''' Store a grain for the minions matched by a target (`{minion: value}`) '''
+        if not self.enabled:
+            return
+
+        expiration = time.time() + self.ttl
+        with self._lock:
+            self._targets[tgt] = (list(values.keys()), expiration)
+            for minion, value in values.items():
+                self._grains[(minion, grain)] = (value, expiration)
+
+    def invalidate(self, grain=None, tgt=None):
+        '''
+        Forget a grain (or all of them) in the minions matched by a target
+        (or in all the minions, if we do not know them). As grains can be
+        used in targets, the list of minions matched by targets is forgotten too.
+        '''
+        with self._lock:
+            minions = self._get(self._targets, tgt) if tgt else None
+            minions = set(minions[0]) if minions else None
+
+            for key in list(self._grains.keys()):
+                minion, g = key
+                if minions is not None and minion not in minions:
+                    continue
+                if grain is None or g == ALL_GRAINS or g == grain or \
+                        g.startswith(grain + ':') or grain.startswith(g + ':'):
+                    del self._grains[key]
+                    self.invalidations += 1
+
+            self._targets = {}
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._grains)
+            self._grains = {}
+            self._targets = {}
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {'ttl': self.ttl,
+                    'entries': len(self._grains),
+                    'expired': len([e for e in self._grains.values() if e[1] < now]),
+                    'targets': len(self._targets),
+                    'minions': len(set(m for m, _ in self._grains.keys())),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations}
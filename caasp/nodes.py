@@ -34,7 +34,8 @@ class CaaSPNodes(CmdBase):
 
     def do_db(self, line):
         log.info('Getting the list of nodes from the database')
-        print_iterator(exec_sql_in_db(DB_QUERY_MINIONS_CMD, wait=True))
+        print_iterator(format_table(
+            db_query(DB_QUERY_MINIONS_CMD, as_dict=True, wait=True)))
 
     def do_ls(self, line):
         '''
@@ -0,0 +1,353 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import json
+import logging
+import re
+import sys
+import time
+from collections import OrderedDict
+
+from .saltret import JSONStreamParser
+from .state import list_states, load_state, save_state
+
+log = logging.getLogger(__name__)
+
+# the log messages Salt prints when running the states
+RUNNING_RE = re.compile(r'Running state \[(.*)\] at time (\S+)')
+COMPLETED_RE = re.compile(r'Completed state \[(.*)\] at time (\S+)(?: \(duration_in_ms=([\d.]+)\))?')
+
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+# the requisites that make a state depend on some other state
+# (plus their `_in` versions, that make the other state depend on it)
+REQUISITES = ['require', 'watch', 'onchanges', 'onfail', 'prereq', 'listen', 'use']
+
+
+class OrchestrationState(object):
+    '''
+    A state in an orchestration
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.sls_id = None
+        self.function = None
+        self.start = None
+        self.end = None
+        self.duration = None  # in seconds
+        self.result = None
+        self.comment = ''
+        self.minions = []
+
+    @property
+    def running(self):
+        return self.start is not None and self.end is None and self.duration is None
+
+    def elapsed(self):
+        if self.duration is not None:
+            return self.duration
+        if self.start is not None:
+            return (self.end or time.time()) - self.start
+        return 0.0
+
+    def to_dict(self):
+        return OrderedDict([('state', self.name),
+                            ('id', self.sls_id or self.name),
+                            ('function', self.function),
+                            ('result', self.result),
+                            ('duration', round(self.elapsed(), 3)),
+                            ('minions', self.minions),
+                            ('comment', self.comment)])
+
+
+class OrchestrationTracker(object):
+    '''
+    Tracks the progress of an orchestration, parsing the log messages
+    of the runner (in its stderr) while it runs and its (JSON) return
+    when it finishes.
+    '''
+
+    def __init__(self, name, progress=None, output_cb=None):
+        self.name = name
+        self.states = OrderedDict()
+        self.started = time.time()
+        self.finished = None
+        self.progress = progress
+        # anything in the output that is not JSON
+        self._parser = JSONStreamParser(garbage_cb=output_cb or sys.stdout.write)
+        self._pending = ''
+
+    def _state(self, name):
+        if name not in self.states:
+            self.states[name] = OrchestrationState(name)
+        return self.states[name]
+
+    def feed_log(self, data):
+        ''' Process some output of the runner in the stderr (maybe incomplete lines) '''
+        self._pending += data
+        while '\n' in self._pending:
+            line, self._pending = self._pending.split('\n', 1)
+            self._log_line(ANSI_RE.sub('', line))
+
+    def _log_line(self, line):
+        m = RUNNING_RE.search(line)
+        if m:
+            state = self._state(m.group(1))
+            state.start = time.time()
+            state.end = None
+            self._progress('running {}'.format(state.name))
+            return
+
+        m = COMPLETED_RE.search(line)
+        if m:
+            state = self._state(m.group(1))
+            state.end = time.time()
+            if m.group(3):
+                state.duration = float(m.group(3)) / 1000.0
+            self._progress('completed {} in {:.1f} secs'.format(state.name, state.elapsed()))
+
+    def feed_output(self, data):
+        ''' Process some (JSON) output of the runner '''
+        for doc in self._parser.feed(data):
+            self._parse_return(doc)
+
+    def _parse_return(self, ret):
+        # look for the `{'<fun>_|-<id>_|-<name>_|-<fun>': {...}}` in the return
+        if not isinstance(ret, dict):
+            return
+
+        if not any('_|-' in k for k in ret.keys()):
+            for value in ret.values():
+                self._parse_return(value)
+            return
+
+        for key, chunk in ret.items():
+            if not isinstance(chunk, dict):
+                continue
+            comps = key.split('_|-')
+            name = chunk.get('name') or chunk.get('__id__') or (comps[2] if len(comps) > 2 else key)
+            state = self._state(name)
+            state.sls_id = chunk.get('__id__')
+            state.function = '.'.join([comps[0], comps[-1]]) if len(comps) > 1 else None
+            state.result = chunk.get('result')
+            state.comment = str(chunk.get('comment', '')).strip().split('\n')[0]
+            if chunk.get('duration') is not None:
+                try:
+                    state.duration = float(chunk['duration']) / 1000.0
+                except (TypeError, ValueError):
+                    pass
+            changes = chunk.get('changes') or {}
+            if isinstance(changes.get('ret'), dict):
+                state.minions = sorted(changes['ret'].keys())
+
+    def finish(self):
+        self.finished = time.time()
+        if self.progress:
+            self.progress(None)
+
+    def _progress(self, msg):
+        if self.progress:
+            done = len([s for s in self.states.values() if not s.running])
+            self.progress('[{}] {} states completed, {}'.format(
+                self.name, done, msg))
+
+    @property
+    def failed(self):
+        return [s for s in self.states.values() if s.result is False]
+
+    def rows(self):
+        ''' The states as a list of rows, sorted by duration '''
+        states = sorted(self.states.values(), key=lambda s: s.elapsed(), reverse=True)
+        return [s.to_dict() for s in states]
+
+    def report(self):
+        return OrderedDict([('orchestration', self.name),
+                            ('duration', round((self.finished or time.time()) - self.started, 3)),
+                            ('states', self.rows())])
+
+    def write_report(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+
+class ProgressLine(object):
+    '''
+    A progress line in a terminal (or some log messages, when
+    the output is not a terminal)
+    '''
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.tty = hasattr(stream, 'isatty') and stream.isatty()
+        self._width = 0
+
+    def __call__(self, msg):
+        if not self.tty:
+            if msg:
+                log.info('orchestration: %s', msg)
+            return
+
+        # clear the previous line
+        self.stream.write('\r' + ' ' * self._width + '\r')
+        if msg:
+            self.stream.write(msg)
+            self._width = len(msg)
+        else:
+            self._width = 0
+        self.stream.flush()
+
+
+class OrchestrationJournal(object):
+    '''
+    A journal of the states completed in a run of an orchestration,
+    so a failed run can be resumed skipping them
+    '''
+
+    PREFIX = 'orch-'
+
+    def __init__(self, orch, orch_args='', pillar=None, run_id=None):
+        self.orch = orch
+        self.orch_args = orch_args
+        self.pillar = pillar or {}
+        self.run_id = run_id or '{}-{}'.format(orch, time.strftime('%Y%m%d%H%M%S'))
+        self.status = 'running'
+        self.started = time.time()
+        self.updated = self.started
+        self.completed = []
+        self.failed = []
+        self.attempts = 0
+
+    @property
+    def filename(self):
+        return self.PREFIX + self.run_id + '.json'
+
+    def record(self, tracker, status):
+        ''' Record the states completed successfully in a run '''
+        for state in tracker.states.values():
+            sid = state.sls_id or state.name
+            if state.result is True and sid not in self.completed:
+                self.completed.append(sid)
+        self.failed = [s.sls_id or s.name for s in tracker.failed]
+        self.status = status
+        self.updated = time.time()
+
+    def to_dict(self):
+        return OrderedDict([('run_id', self.run_id),
+                            ('orchestration', self.orch),
+                            ('args', self.orch_args),
+                            ('pillar', self.pillar),
+                            ('status', self.status),
+                            ('started', self.started),
+                            ('updated', self.updated),
+                            ('attempts', self.attempts),
+                            ('completed', self.completed),
+                            ('failed', self.failed)])
+
+    @classmethod
+    def from_dict(cls, data):
+        journal = cls(data['orchestration'], data.get('args', ''), data.get('pillar'), data['run_id'])
+        journal.status = data.get('status', 'unknown')
+        journal.started = data.get('started', 0)
+        journal.updated = data.get('updated', 0)
+        journal.attempts = data.get('attempts', 0)
+        journal.completed = data.get('completed', [])
+        journal.failed = data.get('failed', [])
+        return journal
+
+    def save(self):
+        save_state(self.filename, self.to_dict())
+
+    @classmethod
+    def load(cls, run_id):
+        data = load_state(cls.PREFIX + run_id + '.json')
+        return cls.from_dict(data) if data else None
+
+    @classmethod
+    def all(cls):
+        ''' All the journals saved, from the oldest to the newest '''
+        journals = []
+        for name in list_states(cls.PREFIX):
+            data = load_state(name)
+            if data:
+                journals.append(cls.from_dict(data))
+        return sorted(journals, key=lambda j: j.started)
+
+
+def get_requisites(high):
+    '''
+    Get the dependencies between the states in an orchestration, from its
+    high data (as returned by `state.orchestrate_show_sls`), as a
+    `{ID: set of IDs it depends on}`
+    '''
+    # the requisites can refer to states by ID or by name
+    names = {}
+    for sid, body in high.items():
+        names[sid] = sid
+        for args in _state_args(body):
+            if 'name' in args:
+                names.setdefault(str(args['name']), sid)
+
+    def refs(value):
+        for ref in value if isinstance(value, list) else [value]:
+            for target in (ref.values() if isinstance(ref, dict) else [ref]):
+                if str(target) in names:
+                    yield names[str(target)]
+
+    deps = {sid: set() for sid in high}
+    for sid, body in high.items():
+        for args in _state_args(body):
+            for req in REQUISITES:
+                for target in refs(args.get(req, [])):
+                    deps[sid].add(target)
+                for target in refs(args.get(req + '_in', [])):
+                    deps[target].add(sid)
+    return deps
+
+
+def _state_args(body):
+    # `{module: ['function', {arg: value}, ...]}` -> `{arg: value}`s
+    if not isinstance(body, dict):
+        return
+    for key, value in body.items():
+        if key.startswith('__') or not isinstance(value, list):
+            continue
+        for arg in value:
+            if isinstance(arg, dict):
+                yield arg
+
+
+def get_excludable(completed, requisites):
+    '''
+    Get the completed states that can be excluded when resuming an
+    orchestration. Salt cannot satisfy a requisite on an excluded state, so
+    the completed states some other state (that must run) depends on must
+    run again too.
+    '''
+    excluded = set(sid for sid in completed if sid in requisites)
+    changed = True
+    while changed:
+        changed = False
+        for sid, deps in requisites.items():
+            if sid not in excluded and deps & excluded:
+                excluded -= deps
+                changed = True
+    return [sid for sid in completed if sid in excluded]
@@ -64,4 +64,33 @@ class CaaSPRoles(CmdBase):
             line = '*'
 
         log.info('Getting roles at %s', line)
-        print_iterator(grain_get(line, "roles"))
\ No newline at end of file
+        result = grain_get_by_minion(line, "roles")
+        for minion, roles in result.items():
+            if isinstance(roles, list):
+                roles = ', '.join(roles)
+            print('{}: {}'.format(minion, roles or ''))
+        for minion in result.failed:
+            log.warning('%s: could not get roles: %s', minion, result[minion])
+        for minion in result.missing:
+            log.warning('%s: no response', minion)
+
+    def do_index(self, line):
+        '''
+        Print the index of roles -> minions used for targeting the
+        nodes with some role (optionally, rebuilding it).
+
+        Usage:
+
+        > roles index [refresh]
+        '''
+        line = line.strip()
+        if line not in ['', 'refresh']:
+            raise CommandError('unknown argument "{}"'.format(line))
+
+        index = get_roles_index(refresh=(line == 'refresh'))
+        if index is None:
+            log.warning('the roles index is not available')
+            return
+
+        for role in sorted(index.keys()):
+            print('{}: {}'.format(role, ', '.join(sorted(index[role]))))
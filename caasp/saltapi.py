@@ -0,0 +1,171 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import http.client
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+from urllib.parse import urlparse
+
+from .defaults import *
+from .errors import SaltClientError
+
+log = logging.getLogger(__name__)
+
+
+class SaltAPIClient(object):
+    '''
+    A client for the salt-api REST interface (`rest_cherrypy`), that
+    authenticates once and reuses the token and a keep-alive connection.
+    '''
+
+    def __init__(self, url=SALT_API_URL, username=SALT_API_USER, password=None,
+                 eauth=SALT_API_EAUTH, ca_file=SALT_API_CA_FILE, insecure=False):
+        self.url = urlparse(url)
+        self.username = username
+        self.password = password
+        self.eauth = eauth
+        self.ca_file = ca_file
+        self.insecure = insecure
+        self.token = None
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.url.scheme == 'https':
+            if self.ca_file and os.path.exists(self.ca_file):
+                context = ssl.create_default_context(cafile=self.ca_file)
+            elif self.insecure:
+                if not self.token:
+                    log.warning('salt-api: %s not found: NOT verifying the certificate of %s',
+                                self.ca_file, self.url.hostname)
+                context = ssl._create_unverified_context()
+            else:
+                # (we would be sending the credentials to anyone)
+                raise SaltClientError('cannot verify the certificate of the salt-api: {} not found '
+                                      '(use --salt-api-insecure for connecting anyway)'.format(self.ca_file))
+            return http.client.HTTPSConnection(self.url.hostname, self.url.port or 443,
+                                               context=context)
+
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80)
+
+    @property
+    def _conn(self):
+        # connections are not thread-safe: keep one per thread
+        return getattr(self._local, 'conn', None)
+
+    @_conn.setter
+    def _conn(self, conn):
+        self._local.conn = conn
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _post(self, path, body):
+        headers = {'Accept': 'application/json',
+                   'Content-Type': 'application/json'}
+        if self.token:
+            headers['X-Auth-Token'] = self.token
+
+        # the server can close our keep-alive connection at any time
+        for attempt in [1, 2]:
+            if not self._conn:
+                self._conn = self._connect()
+            try:
+                self._conn.request('POST', path, body=json.dumps(body), headers=headers)
+                resp = self._conn.getresponse()
+                return resp.status, resp.read()
+            except (http.client.HTTPException, socket.error) as e:
+                self.close()
+                if attempt == 2:
+                    raise SaltClientError('could not talk to salt-api: {}'.format(e))
+
+    def login(self):
+        log.debug('salt-api: authenticating as %s', self.username)
+        status, data = self._post('/login', {'username': self.username,
+                                             'password': self.password,
+                                             'eauth': self.eauth})
+        if status != 200:
+            raise SaltClientError('salt-api authentication failed: {}'.format(status))
+
+        self.token = json.loads(data.decode('utf-8'))['return'][0]['token']
+
+    def run(self, lowstate):
+        ''' Run a lowstate chunk, returning its (structured) result '''
+        if not self.token:
+            self.login()
+
+        status, data = self._post('/', [lowstate])
+        if status == 401:
+            # the token has expired
+            self.login()
+            status, data = self._post('/', [lowstate])
+
+        if status != 200:
+            raise SaltClientError('salt-api: {} failed: {} {}'.format(
+                lowstate.get('fun'), status, data.decode('utf-8', 'replace').strip()))
+
+        return json.loads(data.decode('utf-8'))['return'][0]
+
+    def local(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        ''' Run an execution module in some minions, returning `{minion: return}` '''
+        return self.run({'client': 'local',
+                         'tgt': tgt,
+                         'tgt_type': tgt_type,
+                         'fun': fun,
+                         'arg': arg or [],
+                         'kwarg': kwarg or {}})
+
+    def local_full(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        '''
+        Run an execution module in some minions, returning
+        `{minion: {'ret': return, 'retcode': retcode}}`
+        '''
+        return self.run({'client': 'local',
+                         'tgt': tgt,
+                         'tgt_type': tgt_type,
+                         'fun': fun,
+                         'arg': arg or [],
+                         'kwarg': kwarg or {},
+                         'full_return': True})
+
+    def local_iter(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        ''' Run an execution module in some minions, yielding `(minion, return)` '''
+        for minion, ret in self.local(tgt, fun, arg, kwarg, tgt_type).items():
+            yield minion, ret
+
+    def runner(self, fun, arg=None, kwarg=None):
+        ''' Run a runner in the master '''
+        return self.run({'client': 'runner',
+                         'fun': fun,
+                         'arg': arg or [],
+                         'kwarg': kwarg or {}})
+
+    def wheel(self, fun, kwarg=None):
+        ''' Run a wheel function (ie, `key.*`) in the master '''
+        ret = self.run({'client': 'wheel',
+                        'fun': fun,
+                        'kwarg': kwarg or {}})
+        return ret.get('data', {}).get('return')
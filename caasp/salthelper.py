@@ -0,0 +1,219 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import itertools
+import json
+import logging
+import subprocess
+import threading
+
+from .defaults import *
+from .errors import SaltClientError
+
+log = logging.getLogger(__name__)
+
+# the helper running in the salt-master container: it reads requests
+# (one JSON per line) in its stdin and writes the replies in its stdout
+# (it must work with both Python 2 and 3)
+HELPER_SCRIPT = r'''
+import json, os, sys
+import salt.client, salt.config, salt.runner, salt.wheel
+
+# anything printed by Salt goes to stderr: stdout is only for our replies
+out = os.fdopen(os.dup(1), 'w')
+os.dup2(2, 1)
+
+opts = salt.config.master_config(os.environ.get('SALT_MASTER_CONFIG', '/etc/salt/master'))
+local = salt.client.LocalClient(mopts=opts)
+runner = salt.runner.RunnerClient(opts)
+wheel = salt.wheel.WheelClient(opts)
+
+def reply(obj):
+    out.write(json.dumps(obj, default=repr) + '\n')
+    out.flush()
+
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    try:
+        req = json.loads(line)
+    except ValueError:
+        continue
+
+    rid = req.get('id')
+    try:
+        client = req.get('client')
+        if client == 'local':
+            for ret in local.cmd_iter(req['tgt'], req['fun'], req.get('arg', []),
+                                      tgt_type=req.get('tgt_type', 'glob'),
+                                      kwarg=req.get('kwarg') or None,
+                                      expect_minions=True):
+                for minion, data in ret.items():
+                    reply({'id': rid, 'minion': minion, 'failed': bool(data.get('failed')),
+                           'return': data.get('ret'), 'retcode': data.get('retcode', 0)})
+            reply({'id': rid, 'done': True})
+        elif client == 'runner':
+            ret = runner.cmd(req['fun'], arg=req.get('arg', []), kwarg=req.get('kwarg', {}),
+                             print_event=False)
+            reply({'id': rid, 'return': ret, 'done': True})
+        elif client == 'wheel':
+            ret = wheel.cmd(req['fun'], kwarg=req.get('kwarg', {}), print_event=False)
+            reply({'id': rid, 'return': ret, 'done': True})
+        else:
+            reply({'id': rid, 'done': True})
+    except Exception as e:
+        reply({'id': rid, 'error': '%s: %s' % (type(e).__name__, e), 'done': True})
+'''
+
+# start the helper with the first Python where Salt can be imported
+HELPER_LAUNCHER = 'for py in python3 python; do ' + \
+    '$py -c "import salt.client" 2>/dev/null && exec $py -u -c "$1"; ' + \
+    'done; exit 1'
+
+
+class SaltHelperClient(object):
+    '''
+    A client for a long-lived helper process running in the salt-master
+    container, so we only pay the Salt startup once per session.
+    '''
+
+    _ids = itertools.count()
+
+    def __init__(self, cid, docker='docker'):
+        self.cid = cid
+        self.docker = docker
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        log.debug('salt-helper: starting helper in %s', self.cid)
+        self._proc = subprocess.Popen([self.docker, 'exec', '-i', self.cid,
+                                       'sh', '-c', HELPER_LAUNCHER, 'sh', HELPER_SCRIPT],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL,
+                                      universal_newlines=True)
+
+    def is_alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def close(self):
+        if self._proc:
+            log.debug('salt-helper: stopping helper in %s', self.cid)
+            try:
+                self._proc.stdin.close()
+                self._proc.wait(timeout=5)
+            except Exception:
+                self._proc.kill()
+            self._proc = None
+
+    def _request(self, req):
+        ''' Send a request to the helper, yielding all the replies for it '''
+        with self._lock:
+            if not self.is_alive():
+                self.start()
+
+            req['id'] = next(self._ids)
+            try:
+                self._proc.stdin.write(json.dumps(req) + '\n')
+                self._proc.stdin.flush()
+            except (IOError, OSError) as e:
+                self.close()
+                raise SaltClientError('the Salt helper is gone: {}'.format(e))
+
+            while True:
+                line = self._proc.stdout.readline()
+                if not line:
+                    self.close()
+                    raise SaltClientError('the Salt helper is gone')
+
+                try:
+                    rep = json.loads(line)
+                except ValueError:
+                    log.debug('salt-helper: ignoring "%s"', line.strip())
+                    continue
+
+                if rep.get('id') != req['id']:
+                    continue
+                if 'error' in rep:
+                    raise SaltClientError('{} failed: {}'.format(req.get('fun'), rep['error']))
+
+                yield rep
+                if rep.get('done'):
+                    return
+
+    def ping(self):
+        ''' Check the helper is working '''
+        list(self._request({'client': 'ping'}))
+
+    def _local_replies(self, tgt, fun, arg, kwarg, tgt_type):
+        for rep in self._request({'client': 'local',
+                                  'tgt': tgt,
+                                  'tgt_type': tgt_type,
+                                  'fun': fun,
+                                  'arg': arg or [],
+                                  'kwarg': kwarg or {}}):
+            if 'minion' in rep:
+                yield rep
+
+    def local_iter(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        ''' Run an execution module in some minions, yielding `(minion, return)` as they arrive '''
+        for rep in self._local_replies(tgt, fun, arg, kwarg, tgt_type):
+            if not rep.get('failed'):
+                yield rep['minion'], rep['return']
+
+    def local_full(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        '''
+        Run an execution module in some minions, returning
+        `{minion: {'ret': return, 'retcode': retcode}}` (with
+        `{'failed': True}` for the minions that did not return)
+        '''
+        rets = {}
+        for rep in self._local_replies(tgt, fun, arg, kwarg, tgt_type):
+            if rep.get('failed'):
+                rets[rep['minion']] = {'failed': True}
+            else:
+                rets[rep['minion']] = {'ret': rep['return'], 'retcode': rep.get('retcode', 0)}
+        return rets
+
+    def local(self, tgt, fun, arg=None, kwarg=None, tgt_type='compound'):
+        ''' Run an execution module in some minions, returning `{minion: return}` '''
+        return dict(self.local_iter(tgt, fun, arg, kwarg, tgt_type))
+
+    def _single(self, req):
+        ret = None
+        for rep in self._request(req):
+            ret = rep.get('return', ret)
+        return ret
+
+    def runner(self, fun, arg=None, kwarg=None):
+        ''' Run a runner in the master '''
+        return self._single({'client': 'runner',
+                             'fun': fun,
+                             'arg': arg or [],
+                             'kwarg': kwarg or {}})
+
+    def wheel(self, fun, kwarg=None):
+        ''' Run a wheel function (ie, `key.*`) in the master '''
+        return self._single({'client': 'wheel',
+                             'fun': fun,
+                             'kwarg': kwarg or {}})
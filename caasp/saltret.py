@@ -0,0 +1,175 @@
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import json
+import logging
+import re
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# what Salt prints for the minions that did not return
+NO_RETURN_RE = re.compile(r'^Minion did not return\. \[(.*)\]$')
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_MISSING = 'missing'  # no response (ie, a timeout)
+STATUS_NOT_CONNECTED = 'not-connected'
+
+
+class JSONStreamParser(object):
+    '''
+    An incremental parser for a stream of JSON documents
+    (like the output of `salt --out=json`, with one document per minion,
+    or one for all the minions with `--static`).
+    '''
+
+    def __init__(self, garbage_cb=None):
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self.garbage_cb = garbage_cb
+
+    def feed(self, data):
+        ''' Add some data, returning the documents completed '''
+        self._buf += data
+        docs = []
+        while True:
+            self._buf = self._buf.lstrip()
+            if not self._buf:
+                break
+
+            try:
+                doc, end = self._decoder.raw_decode(self._buf)
+            except ValueError as e:
+                if self._buf[0] in '{[' and self._incomplete(e):
+                    break  # not complete yet
+
+                # something that is not JSON (ie, a warning): skip the line
+                garbage, _, self._buf = self._buf.partition('\n')
+                if self.garbage_cb:
+                    self.garbage_cb(garbage + '\n')
+                else:
+                    log.debug('salt: ignoring "%s"', garbage)
+                continue
+
+            docs.append(doc)
+            self._buf = self._buf[end:]
+
+        return docs
+
+    def _incomplete(self, e):
+        # the document is incomplete when the parser needs more data, but
+        # some lines starting with `[` (like log messages) are not JSON at all
+        rest = self._buf[getattr(e, 'pos', 0):]
+        if not rest.strip():
+            return True
+        return str(e).startswith('Unterminated string') and '\n' not in rest
+
+    def leftover(self):
+        ''' Anything we could not parse '''
+        return self._buf.strip()
+
+
+class SaltResult(object):
+    '''
+    The result of running a Salt function in some minions:
+    a `{minion: return}` mapping plus the return code and
+    the status of each minion.
+    '''
+
+    def __init__(self, fun=None, tgt=None):
+        self.fun = fun
+        self.tgt = tgt
+        self.returns = OrderedDict()
+        self.retcodes = OrderedDict()
+        self.statuses = OrderedDict()
+        self.retcode = 0  # the global return code
+
+    def add(self, minion, ret, retcode=None, status=None):
+        ''' Add the return of a minion '''
+        if status is None:
+            m = NO_RETURN_RE.match(ret) if isinstance(ret, str) else None
+            if m:
+                status = STATUS_NOT_CONNECTED if 'Not connected' in m.group(1) else STATUS_MISSING
+            elif retcode:
+                status = STATUS_FAILED
+            else:
+                status = STATUS_OK
+
+        if status in [STATUS_MISSING, STATUS_NOT_CONNECTED]:
+            ret = None
+
+        self.returns[minion] = ret
+        self.retcodes[minion] = retcode
+        self.statuses[minion] = status
+
+    def add_all(self, rets):
+        ''' Add a `{minion: return}` mapping '''
+        for minion, ret in rets.items():
+            self.add(minion, ret)
+
+    def __getitem__(self, minion):
+        return self.returns[minion]
+
+    def __contains__(self, minion):
+        return minion in self.returns
+
+    def __iter__(self):
+        return iter(self.returns)
+
+    def __len__(self):
+        return len(self.returns)
+
+    def get(self, minion, default=None):
+        return self.returns.get(minion, default)
+
+    def minions(self, status=STATUS_OK):
+        ''' The minions with some status (or all of them, with `status=None`) '''
+        return [m for m, s in self.statuses.items() if status is None or s == status]
+
+    def items(self):
+        ''' The `(minion, return)` of the minions that returned successfully '''
+        return [(m, self.returns[m]) for m in self.minions(STATUS_OK)]
+
+    def values(self):
+        ''' The returns of the minions that returned successfully '''
+        return [self.returns[m] for m in self.minions(STATUS_OK)]
+
+    @property
+    def missing(self):
+        return self.minions(STATUS_MISSING) + self.minions(STATUS_NOT_CONNECTED)
+
+    @property
+    def failed(self):
+        return self.minions(STATUS_FAILED)
+
+    @property
+    def ok(self):
+        return not self.retcode and all(s == STATUS_OK for s in self.statuses.values())
+
+    def to_dict(self):
+        return OrderedDict((m, {'return': self.returns[m],
+                                'retcode': self.retcodes[m],
+                                'status': self.statuses[m]})
+                           for m in self.returns)
+
+    def __repr__(self):
+        return 'SaltResult({}, {}: {})'.format(self.fun, self.tgt, dict(self.returns))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import hashlib
+import logging
+import os
+import re
+
+from .common import expandvars
+from .defaults import *
+from .state import list_states, load_state, prune_states, remove_state, save_state
+
+log = logging.getLogger(__name__)
+
+# the substitutions done in the commands (see `CmdBase.precmd`)
+SHELL_RE = re.compile(r"`.*`")
+PYTHON_RE = re.compile(r"\{\%.*\%\}")
+
+# a `let NAME = value` (or a `let! NAME = value`), where
+# `value` is evaluated by the command (see `CmdBase.do_let`)
+LET_RE = re.compile(r'^let(?:!|\s|$)')
+
+# the prefix for the compiled scripts in the state directory
+SCRIPT_CACHE_PREFIX = 'script-'
+
+# bump this when the compiled form changes
+SCRIPT_CACHE_VERSION = 3
+
+
+class ScriptCommand(object):
+    '''
+    A command in a script, with the places where something must
+    be replaced when it is run (a `shell` command or some `python`
+    code), as `(start, end)` positions in the text
+    '''
+
+    __slots__ = ('lineno', 'text', 'shell', 'python')
+
+    def __init__(self, lineno, text, shell=None, python=None):
+        self.lineno = lineno
+        self.text = text
+        self.shell = tuple(shell) if shell else None
+        self.python = tuple(python) if python else None
+
+    @classmethod
+    def parse(cls, lineno, text):
+        if LET_RE.match(text):
+            return cls(lineno, text)  # (the value is evaluated by `let`)
+
+        # (as the patterns are greedy, there is at most one of each in a line)
+        m = SHELL_RE.search(text)
+        if m:
+            # the Python code is looked for after running the shell command
+            return cls(lineno, text, shell=m.span())
+        m = PYTHON_RE.search(text)
+        return cls(lineno, text, python=m.span() if m else None)
+
+    @property
+    def dynamic(self):
+        return self.shell is not None or self.python is not None
+
+    def could_be_stage(self):
+        ''' Could this command be a `stage` once the substitutions are done? '''
+        first = self.text.split(' ', 1)[0]
+        if first.startswith('stage') or not first:
+            return True
+        return '$' in first or '`' in first or '{%' in first
+
+    def render(self, shell_cb, python_cb, variables=None):
+        '''
+        Get the command that must be run, replacing the `shell` and `python`
+        parts with the output of `shell_cb` and `python_cb` (and the
+        `variables` and environment variables)
+        '''
+        text = self.text
+        if LET_RE.match(text):
+            return text
+
+        if self.shell:
+            start, end = self.shell
+            text = text[:start] + shell_cb(text[start:end]) + text[end:]
+            m = PYTHON_RE.search(text) if '{%' in text else None
+            if m:
+                text = text[:m.start()] + python_cb(m.group()) + text[m.end():]
+        elif self.python:
+            start, end = self.python
+            text = text[:start] + python_cb(text[start:end]) + text[end:]
+
+        if '$' in text:
+            text = expandvars(text, variables)
+        return text
+
+    def to_list(self):
+        return [self.lineno, self.text, self.shell, self.python]
+
+
+def parse_script(content):
+    ''' Parse the content of a script, returning the `ScriptCommand`s (without comments and empty lines) '''
+    commands = []
+    lines = content.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        commands.append(ScriptCommand.parse(lineno, line))
+    return commands
+
+
+def _cache_name(path):
+    return SCRIPT_CACHE_PREFIX + hashlib.sha1(path.encode('utf-8')).hexdigest()[:16] + '.json'
+
+
+def compile_script(filename, cached=True):
+    '''
+    Get the commands in a script, from the compiled scripts cache when
+    the file has not changed (same modification time and size, or same
+    content). The file is not even read when the modification time and
+    the size are the same.
+    '''
+    path = os.path.abspath(filename)
+    if not cached:
+        with open(path, 'rb') as f:
+            return parse_script(f.read().decode('utf-8'))
+
+    st = os.stat(path)
+    name = _cache_name(path)
+    entry = load_state(name)
+    if entry and (entry.get('version') != SCRIPT_CACHE_VERSION or entry.get('path') != path):
+        entry = None
+
+    if entry and entry.get('mtime') == st.st_mtime_ns and entry.get('size') == st.st_size:
+        log.debug('script: using the compiled %s', path)
+        return [ScriptCommand(*c) for c in entry['commands']]
+
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        content = f.read()
+
+    digest = hashlib.sha1(content).hexdigest()
+    if entry and entry.get('hash') == digest:
+        # touched, but not changed
+        entry.update(mtime=st.st_mtime_ns, size=st.st_size)
+        _save_compiled(name, entry)
+        log.debug('script: using the compiled %s', path)
+        return [ScriptCommand(*c) for c in entry['commands']]
+
+    log.debug('script: compiling %s', path)
+    commands = parse_script(content.decode('utf-8'))
+    _save_compiled(name, {'version': SCRIPT_CACHE_VERSION,
+                          'path': path,
+                          'mtime': st.st_mtime_ns,
+                          'size': st.st_size,
+                          'hash': digest,
+                          'commands': [c.to_list() for c in commands]})
+    return commands
+
+
+def _save_compiled(name, entry):
+    try:
+        save_state(name, entry)
+        prune_states(SCRIPT_CACHE_PREFIX, SCRIPT_CACHE_MAX)
+    except (IOError, OSError) as e:
+        log.debug('script: could not save the compiled %s: %s', entry['path'], e)
+
+
+def compiled_scripts():
+    ''' The number of compiled scripts in the cache '''
+    return len(list_states(SCRIPT_CACHE_PREFIX))
+
+
+def forget_compiled_scripts():
+    for name in list_states(SCRIPT_CACHE_PREFIX):
+        remove_state(name)
+
+
+class ScriptReader(object):
+    '''
+    A replacement for the `stdin` of a `Cmd` that returns the commands
+    in a compiled script, with the substitutions already done
+    '''
+
+    compiled = True
+
+    def __init__(self, commands, cmd):
+        self._commands = iter(commands)
+        self._cmd = cmd
+
+    def readline(self):
+        for command in self._commands:
+            if self._cmd.blocked and not command.could_be_stage():
+                # it will be ignored: do not run anything for it
+                return command.text + '\n'
+            return self._cmd.render_command(command) + '\n'
+        return ''
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import io
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from .defaults import *
+
+log = logging.getLogger(__name__)
+
+# the client being served (the requests are served one at a time)
+_client = None
+
+
+class ClientConnection(object):
+    '''
+    The connection with a client, where we send its output
+    (as JSON messages, one per line)
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.alive = True
+        self._lock = threading.Lock()
+
+    def send(self, **msg):
+        if not self.alive:
+            return
+        data = (json.dumps(msg) + '\n').encode('utf-8')
+        with self._lock:
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                # the client is gone, but the command will finish anyway
+                log.debug('server: client gone: %s', e)
+                self.alive = False
+
+
+class OutputRouter(object):
+    '''
+    A replacement for `sys.stdout`/`sys.stderr` that sends the
+    output to the client being served (if any)
+    '''
+
+    def __init__(self, stream, channel):
+        self.stream = stream
+        self.channel = channel
+
+    def write(self, txt):
+        client = _client
+        if client is None:
+            return self.stream.write(txt)
+        client.send(**{self.channel: txt})
+        return len(txt)
+
+    def flush(self):
+        if _client is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return _client is None and self.stream.isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _set_environ(env):
+    os.environ.clear()
+    os.environ.update(env)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError as e:
+            log.debug('server: bad request: %s', e)
+            return
+
+        client = ClientConnection(self.request)
+        code = self.server.run_request(request, client)
+        client.send(exit=code)
+
+
+class CaaSPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    A daemon that runs the commands it gets in a unix socket in a
+    long-lived interpreter, so the caches (containers, passwords,
+    grains...) and connections are reused between commands
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, caasp_cmd):
+        self.path = path
+        self.caasp_cmd = caasp_cmd
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise IOError('there is a daemon listening at {} already'.format(path))
+            os.unlink(path)  # a stale socket
+
+        old_umask = os.umask(0o077)  # (only for us)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+        # commands are run as in a script (ie, errors stop them)
+        self.caasp_cmd.stdin = io.StringIO()
+
+    def run_request(self, request, client):
+        ''' Run the commands in a request, returning the exit status '''
+        global _client
+        with self._lock:
+            _client = client
+            cwd, environ = os.getcwd(), dict(os.environ)
+            try:
+                os.chdir(request.get('cwd') or cwd)
+                if request.get('env') is not None:
+                    # (`$VARS` and backticks must see the environment of the client)
+                    env = {k: v for k, v in request['env'].items() if k not in SERVER_KEEP_ENV}
+                    env.update((k, environ[k]) for k in SERVER_KEEP_ENV if k in environ)
+                    _set_environ(env)
+                for script in request.get('scripts', []):
+                    self.caasp_cmd.load_script(script)
+                if request.get('commands'):
+                    self.caasp_cmd.command_line_args(request['commands'])
+                return 0
+            except SystemExit as e:
+                return e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                log.error('%s', e)
+                return 1
+            finally:
+                self.caasp_cmd.blocked = False
+                self.caasp_cmd.parallel_block = None
+                os.chdir(cwd)
+                _set_environ(environ)
+                _client = None
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(caasp_cmd, path):
+    ''' Serve the commands received in a unix socket (until we are interrupted) '''
+    server = CaaSPServer(path, caasp_cmd)
+
+    # send the output (including the logs) to the clients
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = OutputRouter(stdout, 'out')
+    sys.stderr = OutputRouter(stderr, 'err')
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream in [stdout, stderr]:
+            handler.setStream(sys.stderr)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    log.info('server: listening at %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        sys.stdout, sys.stderr = stdout, stderr
+        log.info('server: stopped')
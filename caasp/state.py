@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import json
+import logging
+import os
+
+from .defaults import *
+
+log = logging.getLogger(__name__)
+
+_state_dir = None
+
+
+def get_state_dir():
+    ''' Get the directory where we keep things between runs (or `None` if there is no one) '''
+    global _state_dir
+    if _state_dir is None:
+        dirs = CAASPCTL_STATE_DIRS
+        if os.environ.get(CAASPCTL_STATE_DIR_ENV):
+            dirs = [os.environ[CAASPCTL_STATE_DIR_ENV]]
+        for d in dirs:
+            d = os.path.expanduser(d)
+            try:
+                if not os.path.isdir(d):
+                    os.makedirs(d, mode=0o700)
+                if os.access(d, os.W_OK):
+                    _state_dir = d
+                    break
+            except OSError as e:
+                log.debug('state: cannot use %s: %s', d, e)
+        else:
+            log.debug('state: no state directory available')
+            _state_dir = ''
+
+    return _state_dir or None
+
+
+def load_state(name, default=None):
+    ''' Load some (JSON) state saved in a previous run '''
+    d = get_state_dir()
+    if not d:
+        return default
+
+    try:
+        with open(os.path.join(d, name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.debug('state: could not load %s: %s', name, e)
+        return default
+
+
+def save_state(name, data):
+    ''' Save some (JSON) state for the next runs '''
+    d = get_state_dir()
+    if not d:
+        return
+
+    import tempfile  # (only needed here, and slow to import)
+
+    # write to a temporary file first, so we never leave a half-written state
+    fd, tmp = tempfile.mkstemp(dir=d, prefix='.' + name)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.rename(tmp, os.path.join(d, name))
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def list_states(prefix):
+    ''' Get the names of the states saved with some prefix (sorted) '''
+    d = get_state_dir()
+    if not d:
+        return []
+    return sorted(f for f in os.listdir(d) if f.startswith(prefix) and not f.startswith('.'))
+
+
+def remove_state(name):
+    ''' Forget some state saved in a previous run '''
+    d = get_state_dir()
+    if not d:
+        return
+    try:
+        os.unlink(os.path.join(d, name))
+    except OSError as e:
+        log.debug('state: could not remove %s: %s', name, e)
+
+
+def prune_states(prefix, keep):
+    ''' Remove the states with some prefix, except the `keep` most recently saved '''
+    d = get_state_dir()
+    if not d:
+        return
+    names = list_states(prefix)
+    if len(names) <= keep:
+        return
+
+    def mtime(name):
+        try:
+            return os.path.getmtime(os.path.join(d, name))
+        except OSError:
+            return 0
+
+    for name in sorted(names, key=mtime)[:len(names) - keep]:
+        remove_state(name)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 SUSE LINUX GmbH, Nuernberg, Germany..
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Authors: (please add yourself when contributing)
+#
+#   - Alvaro Saurin <alvaro.saurin@suse.com>
+#
+
+import functools
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# (`inspect.CO_GENERATOR`, as importing `inspect` is slow)
+CO_GENERATOR = 0x20
+
+# max length of the arguments recorded in a span
+SPAN_ARG_MAX_LEN = 256
+
+REDACTED = '******'
+
+# things that look like secrets in a command line
+SECRETS_RES = [
+    re.compile(r'(?<![\w-])(-p)(\'[^\']*\'|"[^"]*")'),
+    re.compile(r'((?:password|passwd|pass|token|secret)\s*[=:]\s*)(\'[^\']*\'|"[^"]*"|\S+)', re.IGNORECASE),
+    re.compile(r'(echo\s+)(\S+)(?=\s*\|\s*sudo)'),
+]
+
+# arguments with secrets
+SECRET_ARG_RE = re.compile(r'password|passwd|token|secret', re.IGNORECASE)
+
+
+class Span(object):
+
+    __slots__ = ['name', 'cat', 'args', 'start', 'end', 'tid', 'exit_code']
+
+    def __init__(self, name, cat, args, tid):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.tid = tid
+        self.start = time.time()
+        self.end = None
+        self.exit_code = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+
+class Tracer(object):
+    '''
+    Records spans (for commands, processes, Salt calls...) that can be
+    saved as Chrome trace events (see `chrome://tracing`) or summarized.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.started = time.time()
+        self._secrets = set()
+        self._tids = {}
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.started = time.time()
+
+    def register_secret(self, secret):
+        ''' Add some value (ie, a password) that must never be recorded '''
+        if secret and len(secret) > 2:
+            self._secrets.add(secret)
+
+    def redact(self, txt):
+        txt = str(txt)
+        for secret in self._secrets:
+            txt = txt.replace(secret, REDACTED)
+        for r in SECRETS_RES:
+            txt = r.sub(lambda m: m.group(1) + REDACTED, txt)
+        if len(txt) > SPAN_ARG_MAX_LEN:
+            txt = txt[:SPAN_ARG_MAX_LEN] + '...'
+        return txt
+
+    def begin(self, name, cat, args=None):
+        with self._lock:
+            tid = self._tids.setdefault(threading.get_ident(), len(self._tids) + 1)
+        args = OrderedDict((k, REDACTED if SECRET_ARG_RE.search(k) and v else self.redact(v))
+                           for k, v in (args or {}).items() if v is not None and not callable(v))
+        return Span(self.redact(name), cat, args, tid)
+
+    def end(self, span, exit_code=0):
+        span.end = time.time()
+        span.exit_code = exit_code
+        with self._lock:
+            self.spans.append(span)
+
+    def to_chrome(self):
+        ''' The spans as Chrome trace events '''
+        events = []
+        pid = os.getpid()
+        for span in sorted(self.spans, key=lambda s: s.start):
+            args = dict(span.args)
+            args['exit_code'] = span.exit_code
+            events.append({'name': span.name,
+                           'cat': span.cat,
+                           'ph': 'X',
+                           'ts': int((span.start - self.started) * 1e6),
+                           'dur': int(span.duration * 1e6),
+                           'pid': pid,
+                           'tid': span.tid,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_chrome(), f)
+
+    def summary(self, top=20):
+        ''' A summary of the time spent, by category, and the slowest calls '''
+        lines = []
+        total = time.time() - self.started
+        lines.append('Total time: {:.3f} secs, {} spans\n'.format(total, len(self.spans)))
+
+        by_cat = OrderedDict()
+        for span in self.spans:
+            count, secs = by_cat.get(span.cat, (0, 0.0))
+            by_cat[span.cat] = (count + 1, secs + span.duration)
+
+        lines.append('\nTime by category (spans can be nested):\n')
+        for cat, (count, secs) in sorted(by_cat.items(), key=lambda x: x[1][1], reverse=True):
+            lines.append('  {:<10} {:>6} calls {:>10.3f} secs\n'.format(cat, count, secs))
+
+        lines.append('\nSlowest {} calls:\n'.format(top))
+        for span in sorted(self.spans, key=lambda s: s.duration, reverse=True)[:top]:
+            lines.append('  {:>9.3f} secs  {:<8} {:<22} [exit={}] {}\n'.format(
+                span.duration, span.cat, span.name, span.exit_code,
+                ' '.join('{}={}'.format(k, v) for k, v in span.args.items())))
+        return lines
+
+
+tracer = Tracer()
+
+
+def _exit_code(e):
+    if isinstance(e, subprocess.CalledProcessError):
+        return e.returncode
+    if isinstance(e, GeneratorExit):
+        return 'closed'
+    return type(e).__name__
+
+
+class trace_span(object):
+    '''
+    A context manager for recording a span (when tracing is enabled)
+    '''
+
+    def __init__(self, name, cat, **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.span = None
+
+    def __enter__(self):
+        if tracer.enabled:
+            self.span = tracer.begin(self.name, self.cat, self.args)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span:
+            tracer.end(self.span, _exit_code(exc) if exc else 0)
+        return False
+
+
+def _trace_generator(span, gen):
+    try:
+        yield from gen
+    except BaseException as e:
+        tracer.end(span, _exit_code(e))
+        raise
+    tracer.end(span, 0)
+
+
+def traced(cat, name=None):
+    '''
+    A decorator for recording a span for every call to a function
+    (or for all the iteration, for generators), with its arguments
+    '''
+
+    def decorator(func):
+        span_name = name or func.__name__
+        arg_names = func.__code__.co_varnames[:func.__code__.co_argcount]
+
+        def span_args(args, kwargs):
+            values = OrderedDict(zip(arg_names, args))
+            values.update(kwargs)
+            values.pop('self', None)
+            return values
+
+        if func.__code__.co_flags & CO_GENERATOR:
+            @functools.wraps(func)
+            def gen_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return func(*args, **kwargs)
+                span = tracer.begin(span_name, cat, span_args(args, kwargs))
+                return _trace_generator(span, func(*args, **kwargs))
+
+            return gen_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            span = tracer.begin(span_name, cat, span_args(args, kwargs))
+            try:
+                res = func(*args, **kwargs)
+            except BaseException as e:
+                tracer.end(span, _exit_code(e))
+                raise
+            tracer.end(span, 0)
+            return res
+
+        return wrapper
+
+    return decorator
+
+
+def traced_sleep(secs, what):
+    ''' Sleep in a polling loop (recording it) '''
+    with trace_span('sleep: ' + what, 'wait', secs=secs):
+        time.sleep(secs)
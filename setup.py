@@ -1,3 +1,5 @@
+import compileall
+import py_compile
 from distutils.command.bdist_dumb import bdist_dumb
 from distutils.core import setup
 
@@ -10,6 +12,15 @@ class custom_bdist_dumb(bdist_dumb):
             cmd.install_lib = '/'
         return cmd
 
+    def make_archive(self, base_name, format, root_dir=None, **kw):
+        if format == 'zip' and root_dir:
+            # add the bytecode next to the sources (the only place where
+            # zipimport looks for it), so nothing is compiled when running
+            # the zip. The hashes are not checked, as the zip is read-only.
+            compileall.compile_dir(root_dir, quiet=1, legacy=True,
+                                   invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        return bdist_dumb.make_archive(self, base_name, format, root_dir=root_dir, **kw)
+
 
 setup(
     name='caaspctl',
@@ -22,7 +33,8 @@ setup(
     license='BSD',
     entry_points={
         'console_scripts': [
-            'caaspctl = caasp.__main__:main'
+            'caaspctl = caasp.__main__:main',
+            'caaspctl-client = caasp.client:main'
         ],
         'setuptools.installation': [
             'eggsecutable = caasp.__main__:main',